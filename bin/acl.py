@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import re
+
+
+def compile_masks(masks, lower=str.lower):
+    """Compile IRC wildcard masks (* and ?) into one regexp.
+
+    >>> m = compile_masks(['*!*@*.example.com', 'JeDa!*@*'])
+    >>> bool(m.match('jeda!x@y')), bool(m.match('foo!bar@a.example.com'))
+    (True, True)
+    >>> bool(m.match('foo!bar@example.org'))
+    False
+    """
+    if not masks:
+        return None
+    parts = []
+    for mask in masks:
+        mask = re.escape(lower(mask))
+        parts.append(mask.replace("\\*", ".*").replace("\\?", "."))
+    return re.compile("(?:" + "|".join(parts) + ")\\Z", re.DOTALL)
+
+
+class ACL(object):
+    """Roles given to users by their services account or their hostmask.
+
+    A role is a list of entries, "$a:account" for an account name or a
+    nick!user@host mask with wildcards:
+
+        {"owner": ["$a:JeDa"],
+         "admin": ["$a:NeoMahler", "*!*@staff.example.org"]}
+
+    The roles of a user are cached per nick and computed again when the
+    nick, the account or the user@host changes.
+    """
+    def __init__(self, cli, roles=None):
+        self.cli = cli
+        self.load(roles or {})
+        for i in ["nick", "account", "chghost", "quit"]:
+            cli.addhandler(i, self._invalidate)
+
+    def load(self, roles):
+        """(Re)build the matchers from a role dict."""
+        lower = self.cli.lower
+        self.accounts = {}
+        self.masks = {}
+        for role in roles:
+            accounts = [i[3:] for i in roles[role] if i.startswith("$a:")]
+            for account in accounts:
+                self.accounts.setdefault(lower(account), set()).add(role)
+            masks = [i for i in roles[role] if not i.startswith("$a:")]
+            if masks:
+                self.masks[role] = compile_masks(masks, lower)
+        self.cache = {}
+        if self.accounts:
+            # Accounts of users only seen through NAMES need a WHO.
+            self.cli.need("account")
+
+    def identity(self, source):
+        """Return (nick!user@host, account) of a nick or a NickMask.
+
+        The account is None if the user is not logged in or we don't know
+        it yet.
+        """
+        nick = source.split("!")[0]
+        mask = source
+        account = None
+        user = self.cli.getuser(nick)
+        if user is not False:
+            if user.host is not None:
+                mask = "{0}!{1}@{2}".format(nick, user.username, user.host)
+            if "account" in user.known:
+                account = user.account
+        return mask, account
+
+    def roles(self, source):
+        """Return the set of roles of a nick or a NickMask."""
+        nick = self.cli.lower(source.split("!")[0])
+        identity = self.identity(source)
+        try:
+            cached = self.cache[nick]
+            if cached[0] == identity:
+                return cached[1]
+        except KeyError:
+            pass
+        mask, account = identity
+        roles = set()
+        if account is not None:
+            roles.update(self.accounts.get(self.cli.lower(account), ()))
+        if "!" in mask:
+            mask = self.cli.lower(mask)
+            for role in self.masks:
+                if self.masks[role].match(mask):
+                    roles.add(role)
+        roles = frozenset(roles)
+        self.cache[nick] = (identity, roles)
+        return roles
+
+    def check(self, source, *roles):
+        """True if the nick or NickMask has any of the roles."""
+        return not self.roles(source).isdisjoint(roles)
+
+    def _invalidate(self, cli, ev):
+        self.cache.pop(cli.lower(ev.source.split("!")[0]), None)
@@ -1,17 +1,31 @@
 # -*- coding: utf-8 -*-
-import logging
 import socket
 import _thread
 import time
+import collections
 import re
-import textwrap
-import os
-import random
+import string
 import sys
+import threading
 
 _rfc_1459_command_regexp = re.compile("^(:(?P<prefix>[^ ]+) +)?" +
     "(?P<command>[^ ]+)( *(?P<argument> .+))?")
 
+_ascii_casemap = (string.ascii_uppercase, string.ascii_lowercase)
+_casemaps = {
+    'ascii': str.maketrans(*_ascii_casemap),
+    'strict-rfc1459': str.maketrans(_ascii_casemap[0] + '[]\\',
+                                    _ascii_casemap[1] + '{}|'),
+    'rfc1459': str.maketrans(_ascii_casemap[0] + '[]\\~',
+                             _ascii_casemap[1] + '{}|^'),
+}
+
+# QUIT messages of users lost in a netsplit: the two servers' names.
+_netsplit_regexp = re.compile(r"^[\w*-]+(\.[\w*-]+)+ [\w*-]+(\.[\w*-]+)+$")
+
+_tag_value_escapes = {":": ";", "s": " ", "\\": "\\", "r": "\r", "n": "\n"}
+_tag_value_regexp = re.compile(r"\\(.?)")
+
 class FeatureSet(object):
     """
     An implementation of features as loaded from an ISUPPORT server directive.
@@ -27,10 +41,33 @@ class FeatureSet(object):
     >>> f.load_feature('CHANMODES=foo,bar,baz')
     >>> f.chanmodes
     ['foo', 'bar', 'baz']
+
+    The channel mode tables are rebuilt every time a 005 is loaded:
+
+    >>> f.load(['target', 'CHANMODES=b,k,l,imnst', 'PREFIX=(ov)@+', 'msg'])
+    >>> f.modetypes['b'], f.modetypes['l'], f.modetypes['o']
+    ('list', 'set', 'prefix')
+    >>> 'l' in f.plusargs, 'l' in f.minusargs
+    (True, False)
+
+    Nicks and channels are compared with the server's CASEMAPPING:
+
+    >>> f.lower('#Foo[]')
+    '#foo{}'
+    >>> f.load(['target', 'CASEMAPPING=ascii', 'msg'])
+    >>> f.lower('#Foo[]')
+    '#foo[]'
     """
 
+    # Mode types as listed in CHANMODES.
+    _chanmode_types = ('list', 'always', 'set', 'noarg')
+
     def __init__(self):
         self._set_rfc1459_prefixes()
+        self.set('CHANMODES', ['b', 'k', 'l', 'imnpst'])
+        self.set('CASEMAPPING', 'rfc1459')
+        self._compile_modes()
+        self._compile_casemapping()
 
     def _set_rfc1459_prefixes(self):
         "install standard (RFC1459) prefixes"
@@ -51,6 +88,43 @@ class FeatureSet(object):
         "Load the values from the a ServerConnection arguments"
         target, features, msg = arguments[:1], arguments[1:-1], arguments[-1:]
         list(map(self.load_feature, features))
+        self._compile_modes()
+        self._compile_casemapping()
+
+    def _compile_casemapping(self):
+        "pick the translation table for CASEMAPPING, rfc1459 if unknown"
+        table = _casemaps.get(getattr(self, 'casemapping', None),
+                              _casemaps['rfc1459'])
+        if table is not getattr(self, '_casetable', None):
+            self._casetable = table
+            self._folded = {}
+
+    def lower(self, string):
+        "casefold a nick or channel name as the server does"
+        try:
+            return self._folded[string]
+        except KeyError:
+            pass
+        if len(self._folded) > 20000:
+            self._folded.clear()
+        folded = self._folded[string] = string.translate(self._casetable)
+        return folded
+
+    def _compile_modes(self):
+        "build the lookup tables used to parse channel modes"
+        table = {}
+        for kind, letters in zip(self._chanmode_types, self.chanmodes):
+            for c in letters:
+                table[c] = kind
+        for c in self.prefix.values():
+            table[c] = 'prefix'
+        self.modetypes = table
+        # mode letter -> prefix character
+        self.prefixmodes = dict((v, k) for k, v in self.prefix.items())
+        # mode letters that take an argument when set and when unset
+        self.plusargs = frozenset(c for c in table if table[c] != 'noarg')
+        self.minusargs = frozenset(c for c in table
+                                   if table[c] in ('list', 'always', 'prefix'))
 
     def load_feature(self, feature):
         # negating
@@ -117,6 +191,100 @@ class FeatureSet(object):
             return int(value)
         return value
 
+def make_ssl_context(verify=True, certfile=None, keyfile=None, cafile=None):
+    """Build the SSL context used by IRCClient for TLS connections.
+
+    Arguments:
+
+        verify -- check the server's certificate and hostname
+        certfile -- client certificate (PEM), for CertFP or SASL EXTERNAL
+        keyfile -- private key of the client certificate, if not in certfile
+        cafile -- CA bundle to verify the server against instead of the
+                  system's default one
+
+    >>> import ssl
+    >>> context = make_ssl_context()
+    >>> context.verify_mode == ssl.CERT_REQUIRED, context.check_hostname
+    (True, True)
+    >>> context.minimum_version >= ssl.TLSVersion.TLSv1_2
+    True
+    >>> context = make_ssl_context(verify=False)
+    >>> context.verify_mode == ssl.CERT_NONE, context.check_hostname
+    (True, False)
+    """
+    import ssl
+    context = ssl.create_default_context(cafile=cafile)
+    if not verify:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    if certfile:
+        context.load_cert_chain(certfile, keyfile)
+    return context
+
+def certificate_fingerprint(certfile):
+    """Return the SHA-256 fingerprint (CertFP) of a PEM certificate."""
+    import hashlib
+    import ssl
+    with open(certfile) as f:
+        der = ssl.PEM_cert_to_DER_cert(f.read())
+    return hashlib.sha256(der).hexdigest()
+
+def parse_tags(tags):
+    """Parse the IRCv3 message tags of a line (without the leading @).
+
+    >>> parse_tags('aaa=bbb;ccc;example.com/ddd=e\\\\sf') == \\
+    ...     {'aaa': 'bbb', 'ccc': True, 'example.com/ddd': 'e f'}
+    True
+    """
+    res = {}
+    for tag in tags.split(';'):
+        if not tag:
+            continue
+        name, sep, value = tag.partition('=')
+        if value:
+            value = _tag_value_regexp.sub(
+                lambda m: _tag_value_escapes.get(m.group(1), m.group(1)),
+                value)
+        res[name] = value or True
+    return res
+
+def parse_servertime(value):
+    """Convert a server-time tag (2011-10-19T16:40:51.620Z) to a timestamp.
+
+    >>> parse_servertime('2011-10-19T16:40:51.620Z')
+    1319042451.62
+    """
+    import calendar
+    date, sep, fraction = value.rstrip('Z').partition('.')
+    stamp = calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%S"))
+    if fraction:
+        stamp += float('0.' + fraction)
+    return stamp
+
+def ping_payload(line):
+    """Return what a raw PING line asks to be sent back, None if it isn't
+    a PING. Works on bytes, before the line is decoded or parsed.
+
+    >>> ping_payload(b'PING :irc.example.com')
+    b':irc.example.com'
+    >>> ping_payload(b'@time=x :irc.example.com PING :123')
+    b':123'
+    >>> ping_payload(b':nick!u@h PRIVMSG #c :PING ') is None
+    True
+    >>> ping_payload(b'PING'), ping_payload(b':irc.example.com PING')
+    (b'', b'')
+    """
+    parts = line.split(b" ", 3)
+    # Skip the tags and/or the prefix.
+    i = 0
+    if parts[0][:1] == b"@":
+        i += 1
+    if len(parts) > i and parts[i][:1] == b":":
+        i += 1
+    if len(parts) > i and parts[i] == b"PING":
+        return b" ".join(parts[i + 1:])
+    return None
+
 def string_int_pair(target, sep=':'):
     name, value = target.split(sep)
     value = int(value) if value else None
@@ -282,7 +450,16 @@ numeric = {
     "491": "nooperhost",
     "492": "noservicehost",
     "501": "umodeunknownflag",
-    "502": "usersdontmatch"
+    "502": "usersdontmatch",
+    "900": "loggedin",
+    "901": "loggedout",
+    "902": "nicklocked",
+    "903": "saslsuccess",
+    "904": "saslfail",
+    "905": "sasltoolong",
+    "906": "saslaborted",
+    "907": "saslalready",
+    "908": "saslmechs"
 }
 
 codes = dict((v, k) for k, v in list(numeric.items()))
@@ -297,6 +474,11 @@ generated = [
 ]
 
 protocol = [
+    "account",
+    "authenticate",
+    "away",
+    "cap",
+    "chghost",
     "error",
     "join",
     "kick",
@@ -320,8 +502,76 @@ class IRCClient:
         self.connected = False
         self.features = FeatureSet()
         self.handlers = {}
+        # Handlers run one at a time, whatever thread the event comes from
+        # (the reader, DCC...).
+        self.handlerlock = threading.RLock()
+        # Event type -> Dispatcher, built from handlers when needed.
+        self.dispatchers = {}
+        # Lines waiting in the output queue before PRIVMSGs and NOTICEs
+        # are dropped, and which ones: "oldest" or "newest".
+        self.queue_maxlen = 100
+        self.queue_overflow = "oldest"
+        self.queue = OutputQueue(self.queue_maxlen, self.queue_overflow)
+        self.enrich_queue = []
+        self.channels = {}
+        self.index = StateIndex(self.lower)
+        # Casefolded nick -> (time, [(casefolded channel, User)]) of the
+        # users lost in a netsplit, until they come back.
+        self.parked = {}
+        # (nick, servers) that split and still have to be parked.
+        self.splitting = []
+        # Open IRCv3 batches: reference -> (type, parameters, nicks).
+        self.batches = {}
+        self.buffer = LineBuffer()
+        # How lines that aren't UTF-8 are decoded, for the whole network
+        # and for some channels (casefolded name -> encoding).
+        self.fallback_encoding = "cp1252"
+        self.channel_encodings = {}
+        # CTCPs of one message that are dispatched, the rest of a stack
+        # of them is dropped.
+        self.max_ctcps = 3
         self.socket = False
+        # Serializes writes, lines go out from more than one thread.
+        self.sendlock = threading.Lock()
+        # A bin.record.Recorder to save the traffic to, if any.
+        self.recorder = None
+        # A bin.trace.Tracer to time the lines with, if any.
+        self.tracer = None
         self.whoing = False
+        self.tls = False
+        self.ssl_context = None
+        self._tls_session = None
+        # IRCv3 capabilities requested when the server offers them.
+        self.wanted_caps = ["multi-prefix", "extended-join", "account-notify",
+                            "away-notify", "userhost-in-names", "chghost",
+                            "message-tags", "server-time", "batch"]
+        self.capabilities = set()
+        # SASL mechanism ("PLAIN" or "EXTERNAL") to log in with before
+        # registering, None to not use SASL.
+        self.sasl_mechanism = None
+        self.sasl_username = ""
+        self.sasl_password = ""
+        # Casefolded channel -> key (+k), from our JOINs and MODEs.
+        self.channel_keys = {}
+        # Arguments for connect() the next reconnect() uses instead of
+        # the ones of the current connection, if any.
+        self.reconnect_to = None
+        # After ping_interval seconds without reading anything we PING the
+        # server, after ping_timeout the connection is given up as dead.
+        self.ping_interval = 120
+        self.ping_timeout = 240
+        # Seconds the server has to finish the SASL exchange before we
+        # give up on it and register without logging in.
+        self.sasl_timeout = 30
+        self.sasl_authenticated = False
+        self.account = None
+        # User information ("host", "account", "realname", "server") that
+        # is fetched with WHO/WHOIS after NAMES filled the channel rosters.
+        # Nothing by default, whoever uses it asks for it with need().
+        self.needed_info = set()
+        self.enrichdelay = 2
+        # Seconds users lost in a netsplit are kept.
+        self.split_timeout = 3600
 
         self.addhandler("join", self._on_join)
         self.addhandler("part", self._on_part)
@@ -334,26 +584,66 @@ class IRCClient:
         self.addhandler("currenttopic", self._currtopic)
         self.addhandler("whospcrpl", self._whoreply)
         self.addhandler("whoreply", self._normalwhoreply)
-        self.addhandler("enfofwho", self._endofwho)
+        self.addhandler("endofwho", self._endofwho)
         self.addhandler("330", self._whoisaccount)
+        self.addhandler("endofwhois", self._endofwhois)
+        self.addhandler("namreply", self._namreply)
+        self.addhandler("endofnames", self._endofnames)
+        self.addhandler("cap", self._on_cap)
+        self.addhandler("account", self._on_account)
+        self.addhandler("away", self._on_away)
+        self.addhandler("chghost", self._on_chghost)
+        self.addhandler("batch", self._on_batch)
+        self.addhandler("welcome", self._capend)
+        self.addhandler("authenticate", self._on_authenticate)
+        self.addhandler("loggedin", self._loggedin)
+        for i in ["saslsuccess", "saslfail", "sasltoolong", "saslaborted",
+                  "saslalready", "nicklocked"]:
+            self.addhandler(i, self._saslend)
 
     def connect(self, server, port, nick, user, realname,
-            msgdelay=0.5):
+            msgdelay=0.5, tls=False, ssl_context=None):
         if self.connected:
             self.disconnect("Changing servers")
 
-        self.queue = []
+        if ssl_context is not None and ssl_context is not self.ssl_context:
+            # A new context can't resume sessions from the old one.
+            self.ssl_context = ssl_context
+            self._tls_session = None
+        if (server, port) != (getattr(self, 'server', None),
+                              getattr(self, 'port', None)):
+            self._tls_session = None
+
+        self.queue = OutputQueue(self.queue_maxlen, self.queue_overflow)
+        self.enrich_queue = []
         self.channels = {}
+        self.index = StateIndex(self.lower)
+        # Casefolded nick -> (time, [(casefolded channel, User)]) of the
+        # users lost in a netsplit, until they come back.
+        self.parked = {}
+        # (nick, servers) that split and still have to be parked.
+        self.splitting = []
+        # Open IRCv3 batches: reference -> (type, parameters, nicks).
+        self.batches = {}
         self.buffer = LineBuffer()
         self.nickname = nick
+        self.real_nickname = nick
+        self.capabilities = set()
+        self.available_caps = {}
+        self.cap_negotiating = False
+        self.sasl_authenticated = False
+        self.account = None
         self.server = server
         self.port = port
         self.username = user
         self.gecos = realname
         self.msgdelay = msgdelay
+        self.tls = tls
         print("IRC: Connecting to {0}...".format(server))
         try:
             self.socket = socket.create_connection((server, port))
+            if tls:
+                self.socket = self._wrap_socket(self.socket)
             print("IRC: Connected!")
         except socket.error as err:
             print("IRC: Cannot connect to {0}: {1}"
@@ -363,18 +653,164 @@ class IRCClient:
             self.reconnect()
             return
 
+        self.connected = True
         _thread.start_new_thread(self.process_queue, ())
+        _thread.start_new_thread(self.process_enrich, ())
         _thread.start_new_thread(self.process_forever, ())
-        self.connected = True
-        self.lastping = time.time()
+        self.lastread = time.time()
+        _thread.start_new_thread(self.process_keepalive, (self.socket,))
         self._handle_event(Event("connect", None, None))
-        time.sleep(1)
+        # Registration waits until CAP END, so this has to go out first.
+        self.cap_negotiating = True
+        self.cap("LS", "302", urgent=True)
         self.user(user, realname)
         self.nick(nick, True)
 
+    def lower(self, string):
+        """Casefold a nick or channel name with the server's CASEMAPPING.
+        Everything in channels and Channel.users is keyed by this."""
+        return self.features.lower(string)
+
+    def is_me(self, nick):
+        return self.features.lower(nick) == \
+                                        self.features.lower(self.nickname)
+
+    def getchannel(self, channel):
+        """Return the Channel object for a channel, or False."""
+        try:
+            return self.channels[self.features.lower(channel)]
+        except KeyError:
+            return False
+
+    def users_by_account(self, account):
+        """Nicks of the users logged in as account. Users only seen
+        through NAMES are missing unless need("account") was called."""
+        return self._nicks(self.index.accounts.get(self.lower(account), ()))
+
+    def users_by_host(self, host):
+        """Nicks of the users from host, or from any host in a domain
+        given as *.example.com."""
+        host = host.lower()
+        if host.startswith("*."):
+            return self._nicks(self.index.domains.get(host[2:], ()))
+        return self._nicks(self.index.hosts.get(host, ()))
+
+    def channel_ops(self, channel):
+        """Nicks of the users with op (or higher) in channel."""
+        return self._nicks(self.index.ops.get(self.lower(channel), ()))
+
+    def channel_voiced(self, channel):
+        return self._nicks(self.index.voiced.get(self.lower(channel), ()))
+
+    def away_users(self):
+        return self._nicks(self.index.away)
+
+    def user_channels(self, nick):
+        """Names of the channels (of ours) nick is in."""
+        return [self.channels[i].name
+                for i in self.index.channels.get(self.lower(nick), ())]
+
+    def channels_by_account(self, account):
+        """Names of the channels (of ours) someone logged in as account
+        is in."""
+        index = self.index
+        keys = set()
+        for nick in index.accounts.get(self.lower(account), ()):
+            keys |= index.channels[nick]
+        return [self.channels[i].name for i in keys]
+
+    def _nicks(self, keys):
+        return [self.index.nicknames[i] for i in keys]
+
+    def _users(self, nick, *channels):
+        """[(casefolded channel, User)] of nick in our channels, looking
+        in the given (casefolded) ones as well."""
+        key = self.lower(nick)
+        res = []
+        for i in self.index.channels.get(key, set()).union(channels):
+            channel = self.channels.get(i)
+            if channel is None:
+                continue
+            user = channel.users.get(key)
+            if user is not None:
+                res.append((i, user))
+        return res
+
+    def _reindex(self, nick, *channels):
+        """Update the index with what we know now of nick, who may be in
+        channels (casefolded) as well."""
+        self.index.update(self.lower(nick), self._users(nick, *channels))
+
+    def _dropchannel(self, channel):
+        """Forget a channel we are no longer in."""
+        channel = self.channels.pop(self.lower(channel), None)
+        if channel is not None:
+            for user in list(channel.users.values()):
+                self._reindex(user.nickname)
+
     def reconnect(self):
+        if self.reconnect_to is not None:
+            args, self.reconnect_to = self.reconnect_to, None
+            self.connect(*args)
+            return
         self.connect(self.server, self.port, self.nickname, self.username,
-                    self.gecos, self.msgdelay)
+                    self.gecos, self.msgdelay, self.tls)
+
+    def _wrap_socket(self, sock):
+        """Do the TLS handshake, resuming the last session if we have one."""
+        if self.ssl_context is None:
+            self.ssl_context = make_ssl_context()
+        try:
+            sock = self.ssl_context.wrap_socket(sock,
+                                server_hostname=self.server,
+                                session=self._tls_session)
+        except:
+            sock.close()
+            raise
+        if sock.session_reused:
+            print("IRC: TLS session resumed ({0})".format(sock.version()))
+        else:
+            print("IRC: TLS handshake done ({0}, {1})".format(sock.version(),
+                                                            sock.cipher()[0]))
+        return sock
+
+    def _save_tls_session(self):
+        # With TLS 1.3 the session ticket arrives after the handshake, so
+        # the session is only worth keeping once we have read something.
+        session = getattr(self.socket, 'session', None)
+        if session is not None and session.has_ticket:
+            self._tls_session = session
+
+    def _close_socket(self):
+        self._save_tls_session()
+        try:
+            self.socket.shutdown(socket.SHUT_WR)
+            self.socket.close()
+        except:
+            pass
+
+    def decode(self, raw):
+        """Decode a line from the server. ASCII and UTF-8 are decoded as
+        they are, anything else with the encoding of its channel in
+        channel_encodings or with fallback_encoding: old clients send
+        CP1252 or Latin-1, which UTF-8 would turn into U+FFFD.
+        """
+        if raw.isascii():
+            return raw.decode('ascii')
+        try:
+            return raw.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+        encoding = self.fallback_encoding
+        if self.channel_encodings:
+            # [@tags] [:prefix] command target ...
+            words = raw.split(b" ", 4)
+            while words and words[0][:1] in (b"@", b":"):
+                words.pop(0)
+            if len(words) > 1:
+                target = self.lower(words[1].decode('utf-8', 'replace'))
+                encoding = self.channel_encodings.get(target, encoding)
+        return raw.decode(encoding, 'replace')
 
     def process_forever(self):
         while self.connected:
@@ -383,71 +819,178 @@ class IRCClient:
         time.sleep(5)
         self.reconnect()
 
+    def process_keepalive(self, sock):
+        """Send a PING when the server has been quiet for a while, and
+        drop the connection if not even its PONG comes. Many servers only
+        PING idle clients, and a dead link doesn't make recv() return."""
+        pinged = 0
+        while self.connected and self.socket is sock:
+            time.sleep(5)
+            idle = time.time() - self.lastread
+            if idle > self.ping_timeout:
+                print("IRC: Nothing from the server in {0:.0f} seconds, "
+                      "reconnecting".format(idle))
+                try:
+                    # Wakes up the reader, which reconnects.
+                    sock.shutdown(socket.SHUT_RDWR)
+                except:
+                    pass
+                return
+            if idle > self.ping_interval and pinged < self.lastread:
+                pinged = time.time()
+                self.send("PING :keepalive", True)
+
     def process_queue(self):
-        try:  
-            while True:
-                if self.connected is False:
-                    return 0
-                for stuff in self.queue:
-                    self.send_stuff(stuff)
-                    self.queue.remove(stuff)
-                    time.sleep(self.msgdelay)
+        queue = self.queue
+        try:
+            # A reconnection makes a new queue (and a new thread for it).
+            while self.connected and self.queue is queue:
+                stuff = queue.get(self.msgdelay)
+                if stuff is None:
+                    continue
+                self.send_stuff(stuff)
                 time.sleep(self.msgdelay)
         except:
             pass
 
+    def process_enrich(self):
+        """Background WHO/WHOIS sender, one request every enrichdelay
+        seconds and only while nothing else is waiting to be sent."""
+        try:
+            while self.connected:
+                time.sleep(self.enrichdelay)
+                if self.whoing is not False:
+                    if time.time() - self.whoing_since < 60:
+                        continue
+                    # The server forgot about our WHO.
+                    self.whoing = False
+                if self.queue or not self.enrich_queue:
+                    continue
+                job = self.enrich_queue.pop(0)
+                if job[0] == "whois":
+                    self.whois([job[1]])
+                    continue
+                # [0] = #channel, [1] = target
+                self.whoing = [job[1], job[2]]
+                self.whoing_since = time.time()
+                try:
+                    self.features.whox
+                    self.who(job[2], "%tcnuhrsaf,31")
+                except:
+                    self.who(job[2])
+        except:
+            pass
+
+    def need(self, *info):
+        """Ask for user information not given by NAMES to be fetched in
+        the background, for the channels we are already in as well."""
+        self.needed_info.update(info)
+        for i in self.channels:
+            self._enrich(i)
+
+    def _enrich(self, channel, nick=None):
+        """Queue a WHO for a channel (or one user on it) if someone on it
+        lacks information in needed_info."""
+        channel = self.lower(channel)
+        users = self.channels[channel].users.values()
+        if nick is not None:
+            users = [self.channels[channel].getuser(nick)]
+        if not any(self.needed_info - u.known for u in users if u):
+            return
+        job = ("who", channel, nick or channel)
+        if job not in self.enrich_queue and \
+                ("who", channel, channel) not in self.enrich_queue:
+            self.enrich_queue.append(job)
+
     def process_data(self):
         if not self.connected:
             return 1
         try:
             reader = getattr(self.socket, 'read', self.socket.recv)
             new_data = reader(2 ** 14)
+            received = time.time()
         except socket.error:
             # The server hung up.
-            try:
-                self.socket.shutdown(socket.SHUT_WR)
-                self.socket.close()
-            except:
-                pass
+            self._close_socket()
             self.connected = False
             return False
         if not new_data:
             # Read nothing: connection must be down.
-            try:
-                self.socket.shutdown(socket.SHUT_WR)
-                self.socket.close()
-            except:
-                pass
+            self._close_socket()
             self.connected = False
             return False
-        if (self.lastping - time.time()) > random.randrange(250, 325):
-            self.disconnect("Pong timeout: {0} seconds".format((self.lastping - time.time())))
-            return False     
+        self.lastread = received
 
         self.buffer.feed(new_data)
 
-        for line in self.buffer:
-            if not line:
+        buf = self.buffer
+        tracer = self.tracer
+        for raw in buf.raw_lines():
+            if not raw:
                 continue
+            if tracer is not None:
+                tracer.begin(received)
+            if self.recorder is not None:
+                self.recorder.inbound(raw)
+            payload = ping_payload(raw)
+            if payload is not None:
+                # Answered right away, not behind whatever is queued.
+                pong = "PONG"
+                if payload:
+                    pong += " " + payload.decode(buf.encoding, buf.errors)
+                self.send_stuff(pong)
+            line = self.decode(raw)
             print("IRC: FROM SERVER: {0}".format(line))
             self._processline(line)
+            if tracer is not None:
+                tracer.end()
+        if self.splitting:
+            self._flushsplit()
 
     def _currtopic(self, connection, event):
-        try:
-            self.channels[event.arguments[0]]
-        except:
-            self.channels[event.arguments[0]] = Channel(event.arguments[0])
-        self.channels[event.arguments[0]].topic = event.arguments[1]
+        channel = self.getchannel(event.arguments[0])
+        if channel is not False:
+            channel.topic = event.arguments[1]
+
+    def _namreply(self, connection, ev):
+        # [0] = channel type, [1] = #channel, [2] = names
+        key = self.lower(ev.arguments[1])
+        channel = self.channels.get(key)
+        if channel is None:
+            # Someone asked for NAMES of a channel we are not in.
+            return
+        prefixes = self.features.prefix
+        for name in ev.arguments[2].split():
+            i = 0
+            # With multi-prefix we get all the prefixes, not only the highest.
+            while i < len(name) and name[i] in prefixes:
+                i += 1
+            mask = NickMask(name[i:])
+            if "!" in mask:
+                # userhost-in-names
+                user = User(mask.nick, mask.user, mask.host, None, None, None,
+                            "H" + name[:i], self, ["host"])
+            else:
+                user = User(name[i:], None, None, None, None, None,
+                            "H" + name[:i], self)
+            channel.adduser(user)
+            self._reindex(user.nickname, key)
+
+    def _endofnames(self, connection, ev):
+        if self.getchannel(ev.arguments[0]) is not False:
+            self._enrich(ev.arguments[0])
 
     # 31 = Add user
     def _whoreply(self, connection, ev):
         if ev.arguments[0] != "31":
             return 0
-        self.channels[self.whoing[0]].adduser(User(ev.arguments[5],
+        self.getchannel(self.whoing[0]).adduser(User(ev.arguments[5],
                                          ev.arguments[2], ev.arguments[3],
                                         ev.arguments[8], ev.arguments[4],
                                         ev.arguments[7], ev.arguments[6],
-                                        self))
+                                        self, ["host", "account", "realname",
+                                               "server", "away"]))
+        self._reindex(ev.arguments[5], self.lower(self.whoing[0]))
 
     def _endofwho(self, connection, ev):
         self.whoing = False
@@ -455,120 +998,334 @@ class IRCClient:
     def _normalwhoreply(self, connection, ev):
         if self.whoing is False:
             return
-        if ev.arguments[0] == self.whoing[0] or \
-                                             ev.arguments[4] == self.whoing[1]:
-            self.channels[self.whoing[0]].adduser(User(ev.arguments[4],
+        if self.lower(ev.arguments[0]) == self.lower(self.whoing[0]) or \
+                self.lower(ev.arguments[4]) == self.lower(self.whoing[1]):
+            # The realname comes after the hop count.
+            self.getchannel(self.whoing[0]).adduser(User(ev.arguments[4],
                                     ev.arguments[1], ev.arguments[2],
-                                    ev.arguments[6], ev.arguments[3],
-                                    None, ev.arguments[5], self), True)
-            try:
-                self.features.whox
-            except:
-                for i in self.channels:
-                    i = self.channels[i]
-                    l = i.getuser(ev.arguments[4])
-                    if l is not False:
-                        if l.account is not None:
-                            self.channels[self.whoing[0]].getuser(
-                                ev.arguments[4]).account = l.account
-                            return
-                self.whois([ev.arguments[4]])
+                                    ev.arguments[6].split(" ", 1)[-1],
+                                    ev.arguments[3], None, ev.arguments[5],
+                                    self, ["host", "realname", "server",
+                                           "away"]))
+            self._reindex(ev.arguments[4], self.lower(self.whoing[0]))
+            if "account" not in self.needed_info:
+                return
+            user = self.getchannel(self.whoing[0]).getuser(ev.arguments[4])
+            if "account" in user.known:
+                return
+            for i, l in self._users(ev.arguments[4]):
+                if "account" in l.known:
+                    user.account = l.account
+                    user.known.add("account")
+                    return
+            # No WHOX, so the account needs a WHOIS. Low priority as well.
+            if ("whois", ev.arguments[4]) not in self.enrich_queue:
+                self.enrich_queue.append(("whois", ev.arguments[4]))
+
+    def _on_cap(self, connection, event):
+        # CAP * LS [*] :caps, the list can be missing when there are none.
+        subcommand = event.arguments[0]
+        caps = []
+        if len(event.arguments) > 1:
+            caps = event.arguments[-1].split()
+        if subcommand == "LS" or subcommand == "NEW":
+            for cap in caps:
+                name, sep, value = cap.partition("=")
+                self.available_caps[name] = value
+            if len(event.arguments) > 2 and event.arguments[1] == "*":
+                # Multi-line LS, more is coming.
+                return
+            if subcommand == "LS":
+                want = [c for c in self.wanted_caps if c in self.available_caps]
+                if self._sasl_available():
+                    want.append("sasl")
+            else:
+                want = [c.partition("=")[0] for c in caps
+                        if c.partition("=")[0] in self.wanted_caps]
+            if want:
+                self.cap("REQ", *want, urgent=self.cap_negotiating)
+            else:
+                self._capend()
+        elif subcommand == "ACK":
+            for cap in caps:
+                if cap[0] == "-":
+                    self.capabilities.discard(cap[1:])
+                else:
+                    self.capabilities.add(cap)
+            print("IRC: Capabilities enabled: {0}".format(
+                                        " ".join(sorted(self.capabilities))))
+            if "sasl" in caps and self.cap_negotiating:
+                # CAP END waits until we are logged in (or failed to).
+                print("IRC: Authenticating with SASL {0}...".format(
+                                                        self.sasl_mechanism))
+                self.send("AUTHENTICATE " + self.sasl_mechanism, True)
+                _thread.start_new_thread(self._sasl_watchdog, (self.socket,))
+                return
+            self._capend()
+        elif subcommand == "NAK":
+            self._capend()
+        elif subcommand == "DEL":
+            for cap in caps:
+                self.capabilities.discard(cap)
+                self.available_caps.pop(cap, None)
+
+    def _sasl_available(self):
+        if not self.sasl_mechanism or "sasl" not in self.available_caps:
+            return False
+        # CAP 302 servers list their mechanisms: sasl=PLAIN,EXTERNAL
+        mechs = self.available_caps["sasl"]
+        return not mechs or self.sasl_mechanism in mechs.split(",")
+
+    def _on_authenticate(self, connection, event):
+        if event.target != "+":
+            return
+        if self.sasl_mechanism == "PLAIN":
+            import base64
+            payload = "{0}\0{0}\0{1}".format(self.sasl_username,
+                                             self.sasl_password)
+            payload = base64.b64encode(payload.encode('utf-8')).decode()
+        else:
+            payload = ""
+        # Sent in chunks of 400 bytes, with a "+" if the last one is full.
+        for i in range(0, len(payload), 400):
+            self.send("AUTHENTICATE " + payload[i:i + 400], True)
+        if len(payload) % 400 == 0:
+            self.send("AUTHENTICATE +", True)
+
+    def _loggedin(self, connection, event):
+        self.account = event.arguments[1]
+
+    def _sasl_watchdog(self, sock):
+        time.sleep(self.sasl_timeout)
+        if self.socket is not sock or not self.cap_negotiating:
+            # Done (or another connection by now).
+            return
+        print("IRC: SASL authentication timed out")
+        self.send("AUTHENTICATE *", True)
+        self._capend()
+
+    def _saslend(self, connection, event):
+        if event.type == "saslsuccess" or event.type == "saslalready":
+            self.sasl_authenticated = True
+            print("IRC: SASL authentication successful")
+        else:
+            print("IRC: SASL authentication failed: {0}".format(
+                                                        event.arguments[-1]))
+        self._capend()
+
+    def _capend(self, connection=None, event=None):
+        if self.cap_negotiating:
+            self.cap_negotiating = False
+            self.cap("END", urgent=True)
+
+    def _on_account(self, connection, event):
+        nick = parse_nick(event.source)[1]
+        account = event.target
+        if account == "*":
+            account = None
+        for i, l in self._users(nick):
+            l.account = account
+            l.known.add("account")
+        self._reindex(nick)
+
+    def _on_away(self, connection, event):
+        nick = parse_nick(event.source)[1]
+        for i, l in self._users(nick):
+            l.setAway(event.target is not None)
+        self._reindex(nick)
+
+    def _on_chghost(self, connection, event):
+        nick = parse_nick(event.source)[1]
+        for i, l in self._users(nick):
+            l.username = event.target
+            l.host = event.arguments[0]
+        self._reindex(nick)
 
     def _changenick(self, connection, event):
         self.nickname = self.nickname + "_"
         self.nick(self.nickname, True)
 
     def _whoisaccount(self, connection, event):
-        for i in self.channels:
-            i = self.channels[i]
-            l = i.getuser(event.arguments[0])
-            print(l)
-            if l is not False:
-                l.account = event.arguments[1]
+        for i, l in self._users(event.arguments[0]):
+            l.account = event.arguments[1]
+            l.known.add("account")
+        self._reindex(event.arguments[0])
+
+    def _endofwhois(self, connection, event):
+        # No 330 before this means the user isn't logged in.
+        for i, l in self._users(event.arguments[0]):
+            l.known.add("account")
 
     def _on_join(self, connection, event):
-        if parse_nick(event.source)[1] == self.nickname:
-            self.channels[event.target] = Channel(event.target)
-            # [0] = #channel, [1] = target
-            self.whoing = [event.target, event.target]
-            try:
-                self.features.whox
-                self.who(event.target, "%tcnuhrsaf,31")
-            except:
-                self.who(event.target)
+        if self.is_me(parse_nick(event.source)[1]):
+            # The roster comes with NAMES, _endofnames queues the WHO.
+            self.channels[self.lower(event.target)] = Channel(event.target,
+                                                        lower=self.lower)
             self.mode(event.target, "b")
+            return
+        channel = self.getchannel(event.target)
+        mask = NickMask(event.source)
+        if self.lower(mask.nick) in self.parked and self._unpark(event, mask):
+            return
+        if "extended-join" in self.capabilities:
+            # JOIN #channel account :realname
+            account = event.arguments[0]
+            if account == "*":
+                account = "0"
+            channel.adduser(User(mask.nick, mask.user,
+                                        mask.host, event.arguments[1], None,
+                                        account, "H", self,
+                                        ["host", "account", "realname"]))
         else:
-            self.whoing = [event.target, parse_nick(event.source)[1]]
-            try:
-                self.features.whox
-                self.who(parse_nick(event.source)[1], "%tcnuhrsaf,31")
-            except:
-                self.who(parse_nick(event.source)[1])
+            channel.adduser(User(mask.nick, mask.user,
+                                        mask.host, None, None, None, "H", self,
+                                        ["host"]))
+        self._reindex(mask.nick, self.lower(event.target))
+        self._enrich(event.target, mask.nick)
 
     def _on_nick(self, connection, event):
-        if parse_nick(event.source)[1] == self.nickname:
+        nick = parse_nick(event.source)[1]
+        if self.is_me(nick):
             self.nickname = event.target
-        for i in self.channels:
-            i = self.channels[i]
-            l = i.getuser(parse_nick(event.source)[1])
-            if l is not False:
-                i.renameuser(parse_nick(event.source)[1], event.target)
+        channels = [i for i, l in self._users(nick)]
+        for i in channels:
+            self.channels[i].renameuser(nick, event.target)
+        self.index.update(self.lower(nick), [])
+        self._reindex(event.target, *channels)
 
     def _on_banlist(self, connection, event):
-        self.channels[event.arguments[0]].addban(event.arguments[1])
+        self.getchannel(event.arguments[0]).addban(event.arguments[1])
 
     def _on_quit(self, connection, event):
-        for i in self.channels:
-            i = self.channels[i]
-            l = i.getuser(parse_nick(event.source)[1])
-            if l is not False:
-                i.deluser(l)
-        if parse_nick(event.source)[1] == self.nickname:
+        nick = parse_nick(event.source)[1]
+        batch = self.batches.get(event.tags.get("batch"))
+        if batch is not None and batch[0] == "netsplit":
+            batch[2].append(nick)
+            return
+        if event.arguments and _netsplit_regexp.match(event.arguments[0]):
+            self.splitting.append((nick, event.arguments[0]))
+            return
+        for i, l in self._users(nick):
+            self.channels[i].deluser(l)
+        self._reindex(nick)
+        if self.is_me(nick):
             self.channels = {}
+            self.index = StateIndex(self.lower)
+            self.parked = {}
+
+    def _on_batch(self, connection, event):
+        # BATCH +reference type [parameters...], BATCH -reference
+        reference = event.target
+        if reference[0] == "+" and event.arguments:
+            type = event.arguments[0].lower()
+            if type in ("netsplit", "netjoin"):
+                self.batches[reference[1:]] = (type, event.arguments[1:], [])
+        elif reference[0] == "-":
+            batch = self.batches.pop(reference[1:], None)
+            if batch is None:
+                return
+            type, servers, nicks = batch
+            if type == "netsplit":
+                self._park(nicks, " ".join(servers))
+            else:
+                print("IRC: Netjoin ({0}), {1} users back".format(
+                                                " ".join(servers), len(nicks)))
+
+    def _flushsplit(self):
+        splits = collections.OrderedDict()
+        for nick, servers in self.splitting:
+            splits.setdefault(servers, []).append(nick)
+        self.splitting = []
+        for servers in splits:
+            self._park(splits[servers], servers)
+
+    def _park(self, nicks, servers):
+        """Take the users lost in a netsplit out of the channels, all at
+        once, and keep them for when they come back."""
+        now = time.time()
+        for i in [i for i in self.parked
+                  if now - self.parked[i][0] > self.split_timeout]:
+            del self.parked[i]
+        for nick in nicks:
+            users = self._users(nick)
+            for i, l in users:
+                self.channels[i].deluser(l)
+            self.index.update(self.lower(nick), [])
+            if users:
+                self.parked[self.lower(nick)] = (now, users)
+        print("IRC: Netsplit ({0}), {1} users parked".format(servers,
+                                                              len(nicks)))
+
+    def _unpark(self, event, mask):
+        """Put a user back in a channel it was in before a netsplit, as
+        it was then, if this JOIN is it coming back. No WHO is needed."""
+        key = self.lower(mask.nick)
+        channel = self.lower(event.target)
+        parked = self.parked[key][1]
+        for i, user in parked:
+            if i == channel:
+                break
+        else:
+            return False
+        if user.host is None or channel not in self.channels or \
+                (self.lower(user.username or ""), user.host.lower()) != \
+                (self.lower(mask.user or ""), mask.host.lower()):
+            # Somebody else with the nick, or we knew little of it.
+            return False
+        parked.remove((i, user))
+        if not parked:
+            del self.parked[key]
+        user.nickname = mask.nick
+        if "extended-join" in self.capabilities:
+            user.account = event.arguments[0] if event.arguments[0] != "*" \
+                                                else None
+        # The server gives the prefixes back with MODE.
+        user.stats = user.stats[0]
+        user.processPrefix(user.stats)
+        self.channels[channel].adduser(user)
+        self._reindex(mask.nick, channel)
+        batch = self.batches.get(event.tags.get("batch"))
+        if batch is not None and batch[0] == "netjoin":
+            batch[2].append(mask.nick)
+        return True
 
-    def getuser(self, nick):  # Heh, a bit expensive, no?
-        for i in self.channels:
-            i = self.channels[i]
-            l = i.getuser(nick)
-            if l is not False:
-                return l
+    def getuser(self, nick):
+        for i, l in self._users(nick):
+            return l
         return False
 
     def _on_mode(self, connection, event):
-        l = self.separateModes(event.arguments)
-        for i in l:
-            for q in self.features.prefix:
-                if i[0] == ("+" + self.features.prefix[q]):
-                    self.channels[event.target].getuser(i[1]).modifyPrefix(q)
-                    return
-                elif i[0] == ("-" + self.features.prefix[q]):
-                    self.channels[event.target].getuser(i[1]).modifyPrefix(q,
-                                                                         False)
-                    return
-            if i[0] == "+b":
-                self.channels[event.target].addban(i[1])
-            elif i[0] == "-b":
-                self.channels[event.target].delban(i[1])
+        channel = self.getchannel(event.target)
+        prefixmodes = self.features.prefixmodes
+        for mode, arg in self._iterModes(event.arguments):
+            if mode[1] in prefixmodes:
+                l = channel.getuser(arg)
+                if l is not False:
+                    l.modifyPrefix(prefixmodes[mode[1]], mode[0] == "+")
+                    self._reindex(arg)
+            elif mode == "+b":
+                channel.addban(arg)
+            elif mode == "-b":
+                channel.delban(arg)
+            elif mode == "+k":
+                self.channel_keys[self.lower(event.target)] = arg
+            elif mode == "-k":
+                self.channel_keys.pop(self.lower(event.target), None)
 
     def _on_kick(self, connection, event):
-        if event.arguments[0] == self.nickname:
-            try:
-                self.channels[event.target]
-            except:
-                pass
-        else:
-            self.channels[event.target].deluser(
-                    self.channels[event.target].getuser(event.target))
+        self._removeuser(event.target, event.arguments[0])
 
     def _on_part(self, connection, event):
-        if parse_nick(event.source)[1] == self.nickname:
-            try:
-                self.channels[event.target]
-            except:
-                pass
-        else:
-            self.channels[event.target].deluser(
-                    self.channels[event.target].getuser(event.target))
+        self._removeuser(event.target, parse_nick(event.source)[1])
+
+    def _removeuser(self, channel, nick):
+        if self.is_me(nick):
+            self._dropchannel(channel)
+            return
+        channel = self.getchannel(channel)
+        if channel is not False:
+            channel.deluser(channel.getuser(nick))
+            self._reindex(nick)
 
     #from limnoria
     def separateModes(self, args):
@@ -589,92 +1346,80 @@ class IRCClient:
         >>> separateModes(['+sntl', '100'])
         [('+s', None), ('+n', None), ('+t', None), ('+l', 100)]
         """
+        ret = []
+        for mode, arg in self._iterModes(args):
+            try:
+                arg = int(arg)
+            except (TypeError, ValueError):
+                pass
+            ret.append((mode, arg))
+        return ret
+
+    def _iterModes(self, args):
+        """Like separateModes, but yields the arguments untouched."""
         if not args:
-            return []
+            return
         modes = args[0]
         assert modes[0] in '+-', 'Invalid args: %r' % args
-        args = list(args[1:])
-        ret = []
+        plusargs = self.features.plusargs
+        minusargs = self.features.minusargs
+        args = iter(args[1:])
+        requireArguments = plusargs
         for c in modes:
-            if c in '+-':
-                last = c
+            if c == '+':
+                last, requireArguments = c, plusargs
+            elif c == '-':
+                last, requireArguments = c, minusargs
+            elif c in requireArguments:
+                arg = next(args, None)
+                if arg is None:
+                    # It happens, for example with "MODE #channel +b", which
+                    # is used for getting the list of all bans.
+                    continue
+                yield last + c, arg
             else:
-                if last == '+':
-                    #requireArguments = _plusRequireArguments
-                    requireArguments = self.features.chanmodes[0] + \
-                                        self.features.chanmodes[1] + \
-                                        self.features.chanmodes[2]
-                else:
-                    requireArguments = self.features.chanmodes[0]
-                for l in self.features.prefix:
-                    requireArguments += self.features.prefix[l]
-
-                if c in requireArguments:
-                    if not args:
-                        # It happens, for example with "MODE #channel +b", which
-                        # is used for getting the list of all bans.
-                        continue
-                    arg = args.pop(0)
-                    try:
-                        arg = int(arg)
-                    except ValueError:
-                        pass
-                    ret.append((last + c, arg))
-                else:
-                    ret.append((last + c, None))
-        return ret
-
-    def _ping_ponger(self, connection, event):
-        "A global handler for the 'ping' event"
-        connection.pong(event.target)
+                yield last + c, None
 
     def parsemode(self, mode, ev, remove=False):
-        res = []
-        cmodelist = self.features.chanmodes
-        param = cmodelist[0] + cmodelist[1] + cmodelist[2]
-        for i, val in enumerate(self.features.prefix):
-            param = param + self.features.prefix[val]
-        pos = 0
-        for c in ev.arguments[0]:
-            if c == "-":
-                rving = True
-                pass
-            elif c == "+":
-                rving = False
-            else:
-                if c in param:
-                    pos = pos + 1
-            if rving is False and remove is not False:
-                continue
-            elif rving is True and remove is not True:
-                continue
-
-            if c == mode:
-                res.append(ev.arguments[pos])  # BEEP BEEP BEEP BEEP
-        return res
+        """Return the arguments of every `mode` set (or unset if `remove`)
+        by a MODE event."""
+        mode = ("-" if remove else "+") + mode
+        return [arg for m, arg in self._iterModes(ev.arguments) if m == mode]
 
     def _handle_event(self, event):
-        if event.type == "ping":
-            self.lastping = time.time()
-            self._ping_ponger(self, event)
-        try:
-            for handler in self.handlers[event.type]:
-                try:
-                    handler(self, event)
-                except:
-                    pass
-        except:
-            pass
+        # PINGs are answered by process_data before they get here.
+        if self.tracer is not None:
+            trace = self.tracer.current()
+            if trace is not None:
+                event.trace = trace.id
+        with self.handlerlock:
+            try:
+                dispatcher = self.dispatchers.get(event.type)
+                if dispatcher is None or dispatcher.stale(self):
+                    dispatcher = self.dispatchers[event.type] = Dispatcher(
+                                            self, self.handlers[event.type])
+                for handler in dispatcher.handlers(self, event):
+                    try:
+                        handler(self, event)
+                    except:
+                        pass
+            except:
+                pass
 
     def _processline(self, line):
         prefix = None
         command = None
-        arguments = None
+        arguments = []
+        tags = {}
         self._handle_event(Event("all_raw_messages",
                                  self.server,
                                  None,
                                  [line]))
 
+        if line[0] == "@":
+            rawtags, sep, line = line[1:].partition(" ")
+            tags = parse_tags(rawtags)
+
         m = _rfc_1459_command_regexp.match(line)
         if m.group("prefix"):
             prefix = m.group("prefix")
@@ -690,6 +1435,11 @@ class IRCClient:
 
         # Translate numerics into more readable strings.
         command = numeric.get(command, command)
+        if self.splitting and command != "quit":
+            # The netsplit is over (or all of it we got in one read).
+            self._flushsplit()
+        if self.tracer is not None:
+            self.tracer.mark("parsed")
 
         if command == "nick":
             if NickMask(prefix).nick == self.real_nickname:
@@ -700,6 +1450,8 @@ class IRCClient:
             self.real_nickname = arguments[0]
         elif command == "featurelist":
             self.features.load(arguments)
+            # The channel filters may fold differently now.
+            self.dispatchers = {}
 
         if command in ["privmsg", "notice"]:
             target, message = arguments[0], arguments[1]
@@ -714,30 +1466,34 @@ class IRCClient:
                 else:
                     command = "privnotice"
 
+            if command in ["privmsg", "pubmsg"]:
+                ctcptype = "ctcp"
+            else:
+                ctcptype = "ctcpreply"
+            ctcps = 0
             for m in messages:
                 if isinstance(m, tuple):
-                    if command in ["privmsg", "pubmsg"]:
-                        command = "ctcp"
-                    else:
-                        command = "ctcpreply"
-
+                    ctcps += 1
+                    if ctcps > self.max_ctcps:
+                        continue
                     m = list(m)
-                    self._handle_event(Event(command, NickMask(prefix), target,
-                         m))
-                    if command == "ctcp" and m[0] == "ACTION":
+                    self._handle_event(Event(ctcptype, NickMask(prefix),
+                         target, m, tags))
+                    if ctcptype == "ctcp" and m[0] == "ACTION":
                         self._handle_event(Event("action", prefix, target,
-                             m[1:]))
+                             m[1:], tags))
                 else:
                     self._handle_event(Event(command, NickMask(prefix), target,
-                        [m]))
+                        [m], tags))
         else:
             target = None
 
             if command == "quit":
-                arguments = [arguments[0]]
+                arguments = arguments[:1]
             elif command == "ping":
-                target = arguments[0]
-            else:
+                # A bare PING has nothing to send back.
+                target = arguments[0] if arguments else ""
+            elif arguments:
                 target = arguments[0]
                 arguments = arguments[1:]
 
@@ -746,9 +1502,24 @@ class IRCClient:
                     command = "umode"
 
             self._handle_event(Event(command, NickMask(prefix), target,
-                arguments))
+                arguments, tags))
 
-    def addhandler(self, message, function, vip=False):
+    def addhandler(self, message, function, vip=False, **filters):
+        """Call function(cli, event) for the events of type message, before
+        the other handlers if vip. Filters make it get only some of them:
+
+            channels -- channel names, the event has to be in one
+            source -- nick!user@host masks (with * and ?) of who sent it
+            prefix -- strings its first argument (the text of a message)
+                      has to start with, ignoring case
+            addressed -- True for the text starting with our nick as well
+            word -- words, the first word of the text has to be one
+
+        Returns an id for delhandler and filterhandler.
+        """
+        if filters:
+            function = Subscription(function, **filters)
+        self.dispatchers.pop(message, None)
         if vip is False:
             try:
                 self.handlers[message].append(function)
@@ -765,6 +1536,18 @@ class IRCClient:
 
     def delhandler(self, identif):
         del self.handlers[identif[1]][identif[0] - 1]
+        self.dispatchers.pop(identif[1], None)
+
+    def filterhandler(self, identif, **filters):
+        """Give new filters (see addhandler) to a handler, keeping its
+        place."""
+        handlers = self.handlers[identif[1]]
+        function = handlers[identif[0] - 1]
+        function = getattr(function, "function", function)
+        if filters:
+            function = Subscription(function, **filters)
+        handlers[identif[0] - 1] = function
+        self.dispatchers.pop(identif[1], None)
 
     def disconnect(self, message="Sayonara <3"):
         if not self.connected:
@@ -774,27 +1557,31 @@ class IRCClient:
 
         self.quit(message, True)
 
-        try:
-            self.socket.shutdown(socket.SHUT_WR)
-            self.socket.close()
-        except socket.error:
-            pass
+        self._close_socket()
         del self.socket
         self._handle_event(Event("disconnect", self.server, "", [message]))
 
     def send(self, raw, urgent=False):
+        if self.tracer is not None:
+            raw = self.tracer.queued(raw)
         if urgent is False:
-            self.queue.append(raw)
+            self.queue.put(raw)
         else:
             self.send_stuff(raw)
 
     def send_stuff(self, stuff):
+        line = stuff
         stuff = stuff.replace("\n", "")
         bytes_ = stuff.encode('utf-8') + b'\r\n'
         if len(bytes_) > 512:
             print("IRC: Se ha intentado enviar un mensaje muy largo!")
         try:
-            self.socket.send(bytes_)
+            with self.sendlock:
+                self.socket.sendall(bytes_)
+                if self.recorder is not None:
+                    self.recorder.outbound(bytes_[:-2])
+            if self.tracer is not None:
+                self.tracer.sent(line)
             print("IRC: TO SERVER: {0}".format(stuff))
         except socket.error:
             # Ouch!
@@ -823,12 +1610,23 @@ class IRCClient:
         self.send("WHO%s%s" % (target and (" " + target), op and (" " + op)))
 
     def join(self, *channels):
+        """Join channels, given as "#channel" or "#channel key"."""
         for channel in channels:
-            if channel is not "":
+            if channel != "":
+                name, sep, key = channel.partition(" ")
+                if key:
+                    self.channel_keys[self.lower(name)] = key
                 self.send("JOIN {0}".format(channel))
 
+    def channel_key(self, channel):
+        """channel, with its key after it if it has one."""
+        key = self.channel_keys.get(self.lower(channel))
+        if key is None:
+            return channel
+        return "{0} {1}".format(channel, key)
+
     def part(self, channel, msg):
-        del self.channels[channel]
+        self._dropchannel(channel)
         self.send("PART {0} :{1}".format(channel, msg))
 
     def privmsg(self, target, msg, nonewmsg=False):
@@ -868,7 +1666,7 @@ class IRCClient:
         """Send a PRIVMSG command."""
         self.send("PRIVMSG %s :%s" % (target, text))
 
-    def cap(self, subcommand, *args):
+    def cap(self, subcommand, *args, urgent=False):
         """
         Send a CAP command according to `the spec
         <http://ircv3.atheme.org/specification/capability-negotiation-3.1>`_.
@@ -905,7 +1703,7 @@ class IRCClient:
             return args
 
         args = _multi_parameter(args)
-        self.send(' '.join(('CAP', subcommand) + args))
+        self.send(' '.join(('CAP', subcommand) + args), urgent)
 
     def ctcp(self, ctcptype, target, parameter=""):
         """Send a CTCP command."""
@@ -1069,8 +1867,144 @@ class IRCClient:
         self.send("OPER %s %s" % (nick, password))
 
 
+_message_types = frozenset(["privmsg", "pubmsg", "ctcpreply", "ctcp",
+                           "pubnotice", "privnotice", "dccmsg"])
+
+
+class Subscription(object):
+    """A handler that only wants some events of its type (see
+    IRCClient.addhandler for the filters)."""
+    def __init__(self, function, channels=None, source=None, prefix=None,
+                 word=None, addressed=False):
+        self.function = function
+        if isinstance(channels, str):
+            channels = [channels]
+        if isinstance(source, str):
+            source = [source]
+        if isinstance(prefix, str):
+            prefix = [prefix]
+        if isinstance(word, str):
+            word = [word]
+        self.channels = channels
+        self.source = source
+        self.prefix = prefix
+        self.word = word
+        self.addressed = addressed
+
+    def compile(self, cli):
+        """Fold the filters the way cli does, for match()."""
+        from bin.acl import compile_masks
+        self._channels = None
+        if self.channels is not None:
+            self._channels = set(cli.lower(i) for i in self.channels)
+        self._source = compile_masks(self.source, cli.lower)
+        self._prefixes = None
+        if self.prefix is not None or self.addressed:
+            prefixes = list(self.prefix or [])
+            if self.addressed:
+                prefixes.append(cli.nickname or "")
+            if "" not in prefixes:
+                # (An empty one lets everything through.)
+                self._prefixes = tuple(i.lower() for i in prefixes)
+        self._words = None
+        if self.word is not None:
+            self._words = set(i.lower() for i in self.word)
+
+    def keys(self):
+        """The lookup table of Dispatcher this goes in, and its keys
+        there."""
+        if self._words is not None:
+            return "words", self._words
+        if self._channels is not None:
+            return "channels", self._channels
+        if self._prefixes is not None:
+            return "prefixes", set(i[0] for i in self._prefixes)
+        return "others", None
+
+    def match(self, cli, ev, text):
+        if self._channels is not None and (not is_channel(ev.target) or
+                                cli.lower(ev.target) not in self._channels):
+            return False
+        if self._source is not None and not self._source.match(
+                                                    cli.lower(ev.source2)):
+            return False
+        if self._prefixes is not None and (text is None or
+                                not text.lower().startswith(self._prefixes)):
+            return False
+        if self._words is not None and (not text or
+                    text.split(None, 1)[0].lower() not in self._words):
+            return False
+        return True
+
+    def __call__(self, cli, ev):
+        # Called directly (not through a Dispatcher) it filters by itself.
+        self.compile(cli)
+        text = ev.arguments[0] if ev.arguments else None
+        if self.match(cli, ev, text):
+            return self.function(cli, ev)
+
+
+class Dispatcher(object):
+    """The handlers of an event type, with the subscriptions sorted into
+    lookup tables by their most selective filter (leading word, channel,
+    first character of the prefix) so an event is only checked against
+    the ones that may want it, however many there are."""
+    def __init__(self, cli, handlers):
+        # [(position, function)] of the handlers without filters.
+        self.plain = []
+        self.words = {}
+        self.channels = {}
+        self.prefixes = {}
+        self.others = []
+        for position, handler in enumerate(handlers):
+            if not isinstance(handler, Subscription):
+                self.plain.append((position, handler))
+                continue
+            handler.compile(cli)
+            table, keys = handler.keys()
+            if table == "others":
+                self.others.append((position, handler))
+                continue
+            for key in keys:
+                getattr(self, table).setdefault(key, []).append(
+                                                        (position, handler))
+        self.filtered = bool(self.words or self.channels or self.prefixes or
+                             self.others)
+        self.functions = [function for position, function in self.plain]
+        # Prefixes with our nick in them need it to stay the same.
+        self.nickname = None
+        if any(getattr(i, "addressed", False) for i in handlers):
+            self.nickname = cli.nickname
+
+    def stale(self, cli):
+        return self.nickname is not None and self.nickname != cli.nickname
+
+    def handlers(self, cli, ev):
+        """The functions that get ev, in the order they were added."""
+        if not self.filtered:
+            return self.functions
+        text = None
+        if ev.arguments and isinstance(ev.arguments[0], str):
+            text = ev.arguments[0]
+        candidates = list(self.others)
+        if text:
+            if self.words:
+                word = text.split(None, 1)
+                if word:
+                    candidates += self.words.get(word[0].lower(), [])
+            candidates += self.prefixes.get(text[0].lower(), [])
+        if self.channels and is_channel(ev.target):
+            candidates += self.channels.get(cli.lower(ev.target), [])
+        matched = [(position, sub.function) for position, sub in candidates
+                   if sub.match(cli, ev, text)]
+        if not matched:
+            return self.functions
+        return [function for position, function in sorted(self.plain + matched,
+                                                    key=lambda i: i[0])]
+
+
 class Event(object):
-    def __init__(self, type, source, target, arguments=None):
+    def __init__(self, type, source, target, arguments=None, tags=None):
         self.type = type
         self.source = source
         self.source2 = source
@@ -1078,13 +2012,28 @@ class Event(object):
         if arguments is None:
             arguments = []
         self.arguments = arguments
-        if type == "privmsg" or type == "pubmsg" or type == "ctcpreply" or type\
-        == "ctcp" or type == "pubnotice" or type == "privnotice":
+        if tags is None:
+            tags = {}
+        self.tags = tags
+        # When the server says it happened (server-time), or now.
+        try:
+            self.time = parse_servertime(tags["time"])
+        except:
+            self.time = time.time()
+        # Id of the bin.trace.Trace of the line, when tracing.
+        self.trace = None
+        if type in _message_types:
             if not is_channel(target):
                 self.target = parse_nick(source)[1]
             if not is_channel(source):
                 self.source = parse_nick(source)[1]
-            self.splitd = arguments[0].split()
+
+    def __getattr__(self, name):
+        # The words of a message, only split for the handlers using them.
+        if name == "splitd" and self.type in _message_types:
+            self.splitd = self.arguments[0].split()
+            return self.splitd
+        raise AttributeError(name)
 
 
 class NickMask(str):
@@ -1125,6 +2074,10 @@ class LineBuffer(object):
         return (line.decode(self.encoding, self.errors)
             for line in self._lines())
 
+    def raw_lines(self):
+        """The complete lines in the buffer, undecoded."""
+        return self._lines()
+
     def _lines(self):
         lines = self.line_sep_exp.split(self.buffer)
         # save the last, unfinished, possibly empty line
@@ -1138,9 +2091,70 @@ class LineBuffer(object):
         return len(self.buffer)
 
 
+class OutputQueue(object):
+    """The lines waiting to be sent, with a limit for chatter.
+
+    Lines go out in the order they were queued. PRIVMSGs and NOTICEs are
+    low priority: once `maxlen` of them are waiting the oldest (or the
+    newest, depending on `overflow`) is dropped. Other commands are never
+    dropped, so a JOIN can't overtake the NickServ identify before it.
+
+    >>> q = OutputQueue(2)
+    >>> for i in ["PRIVMSG #a :1", "MODE #a +b x", "PRIVMSG #a :1",
+    ...           "PRIVMSG #a :2", "JOIN #b"]:
+    ...     q.put(i)
+    >>> [q.get(0) for i in range(5)], q.dropped
+    (['MODE #a +b x', 'PRIVMSG #a :1', 'PRIVMSG #a :2', 'JOIN #b', None], 1)
+    """
+    low_priority = ("PRIVMSG", "NOTICE")
+
+    def __init__(self, maxlen=100, overflow="oldest"):
+        self.maxlen = maxlen
+        self.overflow = overflow
+        # (sequence number, line), get() takes the lowest of both heads.
+        self.high = collections.deque()
+        self.low = collections.deque()
+        self.sequence = 0
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def put(self, line):
+        with self.cond:
+            self.sequence += 1
+            item = (self.sequence, line)
+            if line.split(" ", 1)[0].upper() not in self.low_priority:
+                self.high.append(item)
+            elif len(self.low) < self.maxlen:
+                self.low.append(item)
+            elif self.overflow == "oldest":
+                self.low.popleft()
+                self.low.append(item)
+                self.dropped += 1
+            else:
+                self.dropped += 1
+                return
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """Return the next line, or None if nothing came in timeout."""
+        with self.cond:
+            if not self.high and not self.low:
+                self.cond.wait(timeout)
+            if self.high and (not self.low or self.high[0] < self.low[0]):
+                return self.high.popleft()[1]
+            if self.low:
+                return self.low.popleft()[1]
+            return None
+
+    def __len__(self):
+        return len(self.high) + len(self.low)
+
+
 class Channel(object):
-    def __init__(self, channel, topic="", modes=""):
+    def __init__(self, channel, topic="", modes="", lower=str.lower):
         self.name = channel
+        # Casefolds nicks, users is keyed by it (IRCClient.lower).
+        self.lower = lower
         self.topic = topic
         self.modes = modes
         self.users = {}
@@ -1154,39 +2168,146 @@ class Channel(object):
         if ban in self.banlist:
             self.banlist.remove(ban)
 
-    def adduser(self, user, normalwho=False):
+    def adduser(self, user):
+        nick = self.lower(user.nickname)
         try:
-            if normalwho is False:
-                self.users[user.nickname] = user
-            else:
-                try:
-                    # Con who si el usuario existe solo añadimos el servidor
-                    self.users[user.nickname].server = user.server
-                except:
-                    self.users[user.nickname] = user
-        except:
-            pass
+            # Si el usuario existe solo añadimos lo que sabemos de nuevo
+            self.users[nick].update(user)
+        except KeyError:
+            self.users[nick] = user
 
     def getuser(self, nick):
         try:
-            return self.users[nick]
+            return self.users[self.lower(nick)]
         except:
             return False
 
     def renameuser(self, oldnick, newnick):
         try:
-            self.users[newnick] = self.users[oldnick]
-            del self.users[oldnick]
-        except:
-            pass
+            user = self.users.pop(self.lower(oldnick))
+        except KeyError:
+            return
+        user.nickname = newnick
+        self.users[self.lower(newnick)] = user
 
     def deluser(self, user):
         try:
-            del self.users[user.nickname]
+            del self.users[self.lower(user.nickname)]
         except:
             pass
 
 
+class StateIndex(object):
+    """What IRCClient knows of the users in its channels, by account, host,
+    away status and channel prefix, so asking for them costs what they are
+    and not every user of every channel.
+
+    Everything is keyed by casefolded nick. IRCClient calls update() with
+    the User objects of a nick every time they change (empty when the nick
+    is gone), and update() replaces what was indexed for it.
+    """
+    def __init__(self, lower=str.lower):
+        self.lower = lower
+        # nick -> the nick as it is written
+        self.nicknames = {}
+        # nick -> set of casefolded channels
+        self.channels = {}
+        # casefolded account -> set of nicks
+        self.accounts = {}
+        # lowercase host -> set of nicks, and the same for each of its
+        # domains (example.com for a.b.example.com)
+        self.hosts = {}
+        self.domains = {}
+        self.away = set()
+        # casefolded channel -> set of nicks
+        self.ops = {}
+        self.voiced = {}
+        # nick -> (account, host, away, ops, voiced) last indexed
+        self.entries = {}
+
+    @staticmethod
+    def _add(index, key, nick):
+        try:
+            index[key].add(nick)
+        except KeyError:
+            index[key] = set([nick])
+
+    @staticmethod
+    def _discard(index, key, nick):
+        nicks = index.get(key)
+        if nicks is not None:
+            nicks.discard(nick)
+            if not nicks:
+                del index[key]
+
+    @staticmethod
+    def domainsof(host):
+        """
+        >>> StateIndex.domainsof("a.b.example.com")
+        ['b.example.com', 'example.com', 'com']
+        """
+        parts = host.split(".")
+        return [".".join(parts[i:]) for i in range(1, len(parts))]
+
+    def _remove(self, nick):
+        entry = self.entries.pop(nick, None)
+        if entry is None:
+            return
+        account, host, away, ops, voiced = entry
+        if account is not None:
+            self._discard(self.accounts, account, nick)
+        if host is not None:
+            self._discard(self.hosts, host, nick)
+            for domain in self.domainsof(host):
+                self._discard(self.domains, domain, nick)
+        if away:
+            self.away.discard(nick)
+        for channel in ops:
+            self._discard(self.ops, channel, nick)
+        for channel in voiced:
+            self._discard(self.voiced, channel, nick)
+
+    def update(self, nick, users):
+        """Index nick as what users, [(casefolded channel, User)], say."""
+        self._remove(nick)
+        if not users:
+            self.nicknames.pop(nick, None)
+            self.channels.pop(nick, None)
+            return
+        account = host = None
+        away = False
+        ops = []
+        voiced = []
+        for channel, user in users:
+            account = account or user.account
+            host = host or user.host
+            away = away or user.away
+            if user.is_op:
+                ops.append(channel)
+            if user.is_voiced:
+                voiced.append(channel)
+        self.nicknames[nick] = users[0][1].nickname
+        self.channels[nick] = set(channel for channel, user in users)
+        if account is not None:
+            account = self.lower(account)
+            self._add(self.accounts, account, nick)
+        if host is not None:
+            host = host.lower()
+            self._add(self.hosts, host, nick)
+            for domain in self.domainsof(host):
+                self._add(self.domains, domain, nick)
+        if away:
+            self.away.add(nick)
+        for channel in ops:
+            self._add(self.ops, channel, nick)
+        for channel in voiced:
+            self._add(self.voiced, channel, nick)
+        self.entries[nick] = (account, host, away, ops, voiced)
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class User(object):
     account = None
     server = None
@@ -1195,7 +2316,7 @@ class User(object):
     host = None
 
     def __init__(self, nickname, username, host, gecos, server, account, stats,
-                                                                        cli):
+                                                            cli, known=()):
         self.nickname = nickname
         self.username = username
         self.host = host
@@ -1206,11 +2327,29 @@ class User(object):
         self.cli = cli
         self.processPrefix(stats)
         self.stats = stats
+        # Which of host, account, realname, server and away we really know.
+        self.known = set(known)
+
+    def update(self, other):
+        """Merge in what another User object for the same nick knows."""
+        for i in other.known:
+            if i == "host":
+                self.username = other.username
+                self.host = other.host
+            elif i == "realname":
+                self.realname = other.realname
+            elif i != "away":
+                setattr(self, i, getattr(other, i))
+        if "away" in other.known:
+            self.stats = other.stats
+        else:
+            # NAMES and JOIN don't say if somebody is away.
+            self.stats = self.stats[0] + other.stats[1:]
+        self.known |= other.known
+        self.processPrefix(self.stats)
 
     def processPrefix(self, stats):
-        oprefixes = ""
-        for i in self.cli.features.prefix:
-            oprefixes += i
+        oprefixes = self.cli.features.prefix
         if stats[0] == "G":
             self.away = True
         else:
@@ -1235,6 +2374,11 @@ class User(object):
                 self.stats = self.stats.replace(prefix, "")
         self.processPrefix(self.stats)
 
+    def setAway(self, away=True):
+        self.stats = ("G" if away else "H") + self.stats[1:]
+        self.away = away
+        self.known.add("away")
+
     def isVoiced(self, op=False):
         if op is True and self.is_op is True:
             return True
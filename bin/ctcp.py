@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import collections
+import time
+
+from bin.ratelimit import RateLimiter
+
+
+class CTCPResponder(object):
+    """Answers CTCP PING, VERSION and USERINFO without letting a flood of
+    them fill the output queue.
+
+    Every source (by host) has a budget of replies and all of them share
+    another one. A source going over its budget is ignored for `ignore`
+    seconds. The replies are built once (again when our nick changes,
+    for USERINFO), only the PING one has to echo its argument.
+    """
+    def __init__(self, version, per_source=(3, 60), total=(10, 30),
+                 ignore=300):
+        self.version = version
+        self.set_limits(per_source, total, ignore)
+        # host -> time until which it is ignored, in that order as every
+        # source is ignored for as long.
+        self.ignored = collections.OrderedDict()
+        self.replies = {}
+        self.nickname = None
+
+    def set_limits(self, per_source, total, ignore):
+        self.sources = RateLimiter(*per_source)
+        self.total = RateLimiter(*total)
+        self.ignore = ignore
+
+    def _build(self, nickname):
+        self.nickname = nickname
+        self.replies = {
+            "VERSION": "VERSION JeDaBot {}".format(self.version),
+            "USERINFO": "USERINFO {}, a bot with JeDaBot's brain."
+                        .format(nickname),
+        }
+
+    def allowed(self, key):
+        """Take a reply from the budgets of key and the global one."""
+        now = time.time()
+        until = self.ignored.get(key)
+        if until is not None:
+            if until > now:
+                return False
+            del self.ignored[key]
+        if not self.sources.check(key):
+            ignored = self.ignored
+            while ignored and (next(iter(ignored.values())) <= now or
+                               len(ignored) >= 1000):
+                ignored.popitem(last=False)
+            ignored[key] = now + self.ignore
+            print("CTCP: Ignoring {0} for {1} seconds, flooding".format(
+                                                         key, self.ignore))
+            return False
+        return self.total.check(None)
+
+    def reply(self, cli, ev):
+        """What to answer to a CTCP event, or None."""
+        request = ev.arguments[0].upper()
+        if request == "PING":
+            if len(ev.arguments) < 2:
+                return None
+            # No more than a PING reply is worth.
+            return "PING " + ev.arguments[1][:64]
+        if self.nickname != cli.nickname:
+            self._build(cli.nickname)
+        return self.replies.get(request)
+
+    def on_ctcp(self, cli, ev):
+        if ev.source is None:
+            # Sent by a server, there's nobody to answer.
+            return
+        answer = self.reply(cli, ev)
+        if answer is None:
+            return
+        try:
+            key = cli.lower(ev.source2.host)
+        except (AttributeError, IndexError):
+            # No host in the prefix, limit by all of it.
+            key = cli.lower(ev.source2)
+        if self.allowed(key):
+            cli.ctcp_reply(ev.source, answer)
@@ -0,0 +1,490 @@
+# -*- coding: utf-8 -*-
+"""DCC CHAT and DCC SEND (with RESUME).
+
+Every DCC socket is non-blocking and lives in one selector, run by one
+thread for all of them; files are sent with os.sendfile(), so they never
+go through Python. The client gets dcc_connect, dcc_disconnect and
+dccmsg events, with the DCCConnection in their dcc attribute.
+
+Anybody can connect to the port of an offer, so a DCC CHAT we offer
+only starts once the peer sends a code we give to the nick over IRC.
+"""
+import collections
+import errno
+import hmac
+import os
+import secrets
+import selectors
+import socket
+import struct
+import threading
+import time
+
+from bin.client import Event, NickMask
+
+
+def ip_to_int(ip):
+    """
+    >>> ip_to_int("127.0.0.1")
+    2130706433
+    """
+    return struct.unpack("!I", socket.inet_aton(ip))[0]
+
+
+def int_to_ip(number):
+    """
+    >>> int_to_ip("2130706433")
+    '127.0.0.1'
+    """
+    return socket.inet_ntoa(struct.pack("!I", int(number)))
+
+
+class DCCConnection(object):
+    """A DCC CHAT or a DCC SEND, from its offer until it is closed."""
+    def __init__(self, manager, kind, mask):
+        self.manager = manager
+        # "chat" or "send"
+        self.kind = kind
+        self.mask = NickMask(mask)
+        self.nick = self.mask.nick
+        self.sock = None
+        # The socket listening for the peer, while this is an offer.
+        self.listener = None
+        self.port = None
+        self.created = time.time()
+        self.connected = False
+        self.connected_at = None
+        self.closed = False
+        self.inbuf = b""
+        self.outbuf = bytearray()
+        # What the peer has to send first in a DCC CHAT we offered.
+        self.code = None
+        self.lock = threading.Lock()
+        # DCC SEND
+        self.file = None
+        self.filename = None
+        self.size = 0
+        self.offset = 0
+
+    def send(self, text):
+        """Send a line through a DCC CHAT."""
+        with self.lock:
+            self.outbuf += text.replace("\n", " ").encode("utf-8") + b"\n"
+        self.manager._call(self.manager._want_write, self)
+
+    def close(self):
+        self.manager._call(self.manager._close, self)
+
+
+class DCCClient(object):
+    """What command handlers get as the client for a line said in a DCC
+    CHAT: their replies go back through it, the rest goes to the IRC
+    client."""
+    def __init__(self, cli, conn):
+        self.cli = cli
+        self.conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self.cli, name)
+
+    def msg(self, target, text, nonewmsg=False):
+        self.conn.send(text)
+
+    privmsg = notice = msg
+
+
+class DCCManager(object):
+    r"""The DCC connections of an IRCClient.
+
+    Arguments:
+
+        cli -- the IRCClient offers are sent with and events go to
+        host -- address given to peers, by default the one of the IRC
+                connection (it has to be reachable by them)
+        ports -- (first, last) ports to listen on, (0, 0) for any
+        timeout -- seconds an offer waits for the peer to connect, and
+                   then for the code of a DCC CHAT
+        accept -- function(cli, ev) deciding if a DCC CHAT offered to us
+                  is taken, none is by default
+
+    Offering a DCC CHAT, the peer gets in with the code sent to the nick:
+
+    >>> class Client(object):
+    ...     lower = staticmethod(str.lower)
+    ...     def __init__(self):
+    ...         self.sent, self.events = [], []
+    ...     def addhandler(self, type, function):
+    ...         pass
+    ...     def ctcp(self, type, nick, text):
+    ...         self.sent.append(text)
+    ...     def notice(self, nick, text):
+    ...         self.sent.append(text)
+    ...     def decode(self, line):
+    ...         return line.decode("utf-8")
+    ...     def _handle_event(self, ev):
+    ...         self.events.append((ev.type, ev.arguments))
+    >>> def until(condition):
+    ...     deadline = time.time() + 5
+    ...     while not condition() and time.time() < deadline:
+    ...         time.sleep(0.05)
+    ...     return condition()
+    >>> def connect(conn):
+    ...     peer = socket.create_connection(("127.0.0.1", conn.port), 5)
+    ...     return peer, peer.makefile("rb")
+    >>> cli = Client()
+    >>> dcc = DCCManager(cli, host="127.0.0.1", timeout=1)
+    >>> conn = dcc.chat("nick!user@host")
+    >>> cli.sent[0] == "CHAT chat 2130706433 {0}".format(conn.port)
+    True
+    >>> peer, lines = connect(conn); lines.readline()
+    DCC: CHAT with nick connected
+    b'Send me the code I gave you in a notice.\n'
+    >>> cli.sent[1] == "DCC CHAT code: " + conn.code
+    True
+    >>> peer.sendall(conn.code.encode() + b"\nhello\n")
+    >>> lines.readline()
+    b'OK, go ahead.\n'
+    >>> until(lambda: len(cli.events) == 2), cli.events
+    (True, [('dcc_connect', ['chat']), ('dccmsg', ['hello'])])
+    >>> conn.send("hi")
+    >>> lines.readline()
+    b'hi\n'
+    >>> lines.close(); peer.close(); until(lambda: len(cli.events) == 3)
+    DCC: CHAT with nick closed
+    True
+    >>> cli.events[-1]
+    ('dcc_disconnect', ['chat'])
+
+    Whoever doesn't send the code in `timeout` seconds is disconnected:
+
+    >>> conn = dcc.chat("nick!user@host")
+    >>> peer, lines = connect(conn); lines.read()
+    DCC: CHAT with nick connected
+    DCC: nick didn't send the code
+    DCC: CHAT with nick closed
+    b'Send me the code I gave you in a notice.\n'
+    >>> lines.close(); peer.close()
+
+    A file offered with DCC SEND goes out once the peer connects, and the
+    connection is closed when the peer acknowledges all of it:
+
+    >>> import tempfile
+    >>> with tempfile.NamedTemporaryFile(suffix=".txt") as f:
+    ...     _ = f.write(b"x" * 100000)
+    ...     f.flush()
+    ...     conn = dcc.sendfile("nick!user@host", f.name)
+    >>> cli.sent[-1].split()[2:] == ["2130706433", str(conn.port), "100000"]
+    True
+    >>> peer, lines = connect(conn); data = lines.read(100000)
+    DCC: SEND with nick connected
+    >>> data == b"x" * 100000
+    True
+    >>> peer.sendall(struct.pack("!I", len(data))); lines.read()
+    DCC: SEND with nick closed
+    b''
+    >>> lines.close(); peer.close()
+    >>> dcc.stop()
+    """
+    def __init__(self, cli, host=None, ports=(0, 0), timeout=120,
+                 accept=None):
+        self.cli = cli
+        self.host = host
+        self.ports = ports
+        self.timeout = timeout
+        self.accept = accept
+        self.selector = selectors.DefaultSelector()
+        # Offers and connections.
+        self.connections = []
+        # Work for the selector thread, from the other ones.
+        self.calls = collections.deque()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._wake_w.setblocking(False)
+        self.selector.register(self._wake_r, selectors.EVENT_READ,
+                               (self._on_wake, None))
+        self.running = False
+        cli.addhandler("ctcp", self._on_ctcp)
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def stop(self):
+        self._call(self._closeall)
+
+    def _call(self, function, *args):
+        """Run function(*args) in the selector thread."""
+        self.calls.append((function, args))
+        try:
+            self._wake_w.send(b"\0")
+        except OSError:
+            pass
+
+    def _loop(self):
+        while self.running:
+            for key, events in self.selector.select(1):
+                callback, conn = key.data
+                try:
+                    callback(conn, events)
+                except OSError as err:
+                    print("DCC: Connection with {0} failed: {1}".format(
+                                                            conn.nick, err))
+                    self._close(conn)
+            while self.calls:
+                function, args = self.calls.popleft()
+                function(*args)
+            now = time.time()
+            for conn in list(self.connections):
+                if not conn.connected and now - conn.created > self.timeout:
+                    print("DCC: {0} didn't connect".format(conn.nick))
+                    self._close(conn)
+                elif conn.connected and conn.code is not None and \
+                        now - conn.connected_at > self.timeout:
+                    print("DCC: {0} didn't send the code".format(conn.nick))
+                    self._close(conn)
+
+    def _on_wake(self, conn, events):
+        try:
+            while self._wake_r.recv(512):
+                pass
+        except OSError:
+            pass
+
+    def _address(self):
+        if self.host:
+            return self.host
+        return self.cli.socket.getsockname()[0]
+
+    def _listen(self):
+        """A listening socket on one of the ports."""
+        first, last = self.ports
+        for port in range(first, last + 1):
+            sock = socket.socket()
+            try:
+                sock.bind(("", port))
+            except OSError:
+                sock.close()
+                continue
+            sock.listen(1)
+            sock.setblocking(False)
+            return sock
+        raise OSError(errno.EADDRINUSE, "No free port for DCC")
+
+    def _offer(self, conn, request):
+        conn.listener = self._listen()
+        conn.port = conn.listener.getsockname()[1]
+        self.connections.append(conn)
+        self._call(self._register, conn.listener, selectors.EVENT_READ,
+                   self._on_accept, conn)
+        self.cli.ctcp("DCC", conn.nick, request.format(
+                            ip=ip_to_int(self._address()), port=conn.port,
+                            name=conn.filename, size=conn.size))
+        self.start()
+        return conn
+
+    def chat(self, mask):
+        """Offer a DCC CHAT to nick!user@host, return its DCCConnection."""
+        conn = DCCConnection(self, "chat", mask)
+        conn.code = secrets.token_hex(4)
+        return self._offer(conn, "CHAT chat {ip} {port}")
+
+    def sendfile(self, mask, path):
+        """Offer a file with DCC SEND, return its DCCConnection."""
+        conn = DCCConnection(self, "send", mask)
+        conn.file = open(path, "rb")
+        conn.size = os.fstat(conn.file.fileno()).st_size
+        conn.filename = os.path.basename(path).replace(" ", "_")
+        try:
+            return self._offer(conn, "SEND {name} {ip} {port} {size}")
+        except OSError:
+            conn.file.close()
+            raise
+
+    def connect_chat(self, mask, ip, port):
+        """Connect to a DCC CHAT offered by nick!user@host."""
+        conn = DCCConnection(self, "chat", mask)
+        conn.sock = socket.socket()
+        conn.sock.setblocking(False)
+        err = conn.sock.connect_ex((ip, port))
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            conn.sock.close()
+            raise OSError(err, os.strerror(err))
+        self.connections.append(conn)
+        self._call(self._register, conn.sock, selectors.EVENT_WRITE,
+                   self._on_connected, conn)
+        self.start()
+        return conn
+
+    # In the selector thread from here on.
+
+    def _register(self, sock, events, callback, conn):
+        if not conn.closed:
+            self.selector.register(sock, events, (callback, conn))
+
+    def _events(self, conn):
+        if conn.kind == "send":
+            if conn.offset < conn.size:
+                return selectors.EVENT_READ | selectors.EVENT_WRITE
+            return selectors.EVENT_READ
+        with conn.lock:
+            if conn.outbuf:
+                return selectors.EVENT_READ | selectors.EVENT_WRITE
+        return selectors.EVENT_READ
+
+    def _want_write(self, conn):
+        if conn.connected and not conn.closed:
+            self.selector.modify(conn.sock, self._events(conn),
+                                 (self._on_data, conn))
+
+    def _on_accept(self, conn, events):
+        sock, address = conn.listener.accept()
+        self.selector.unregister(conn.listener)
+        conn.listener.close()
+        conn.listener = None
+        sock.setblocking(False)
+        conn.sock = sock
+        self._connected(conn)
+
+    def _on_connected(self, conn, events):
+        err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise OSError(err, os.strerror(err))
+        self.selector.unregister(conn.sock)
+        self._connected(conn)
+
+    def _connected(self, conn):
+        conn.connected = True
+        conn.connected_at = time.time()
+        print("DCC: {0} with {1} connected".format(conn.kind.upper(),
+                                                    conn.nick))
+        self.selector.register(conn.sock, self._events(conn),
+                               (self._on_data, conn))
+        if conn.code is not None:
+            # Whoever connected has to prove they are the nick.
+            self.cli.notice(conn.nick, "DCC CHAT code: " + conn.code)
+            conn.send("Send me the code I gave you in a notice.")
+            return
+        self._event(conn, "dcc_connect", [conn.kind])
+
+    def _on_data(self, conn, events):
+        if events & selectors.EVENT_READ:
+            data = conn.sock.recv(4096)
+            if not data:
+                self._close(conn)
+                return
+            if conn.kind == "chat":
+                self._lines(conn, data)
+            else:
+                # Acknowledgements (4 bytes) of what was received, only
+                # the last one counts.
+                data = conn.inbuf + data
+                end = len(data) // 4 * 4
+                conn.inbuf = data[end:]
+                if end and conn.offset >= conn.size and struct.unpack(
+                        "!I", data[end - 4:end])[0] == conn.size & 0xffffffff:
+                    self._close(conn)
+                    return
+        if events & selectors.EVENT_WRITE and not conn.closed:
+            if conn.kind == "chat":
+                with conn.lock:
+                    try:
+                        sent = conn.sock.send(conn.outbuf)
+                    except BlockingIOError:
+                        sent = 0
+                    del conn.outbuf[:sent]
+            else:
+                try:
+                    conn.offset += os.sendfile(conn.sock.fileno(),
+                                               conn.file.fileno(),
+                                               conn.offset, 2 ** 20)
+                except BlockingIOError:
+                    pass
+            self.selector.modify(conn.sock, self._events(conn),
+                                 (self._on_data, conn))
+
+    def _lines(self, conn, data):
+        lines = (conn.inbuf + data).split(b"\n")
+        conn.inbuf = lines.pop()
+        if len(conn.inbuf) > 4096:
+            # Not a line, somebody is playing.
+            conn.inbuf = b""
+        for line in lines:
+            line = self.cli.decode(line.rstrip(b"\r"))
+            if not line:
+                continue
+            if conn.code is not None:
+                if not hmac.compare_digest(line.strip(), conn.code):
+                    print("DCC: Wrong code for the CHAT with {0}".format(
+                                                                conn.nick))
+                    self._close(conn)
+                    return
+                conn.code = None
+                conn.send("OK, go ahead.")
+                self._event(conn, "dcc_connect", [conn.kind])
+                continue
+            self._event(conn, "dccmsg", [line])
+
+    def _event(self, conn, type, arguments):
+        # _handle_event serializes the handlers with the ones of the
+        # thread reading from the server.
+        ev = Event(type, conn.mask, conn.nick, arguments)
+        ev.dcc = conn
+        self.cli._handle_event(ev)
+
+    def _close(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        if conn.connected:
+            print("DCC: {0} with {1} closed".format(conn.kind.upper(),
+                                                     conn.nick))
+        for sock in (conn.listener, conn.sock):
+            if sock is None:
+                continue
+            try:
+                self.selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            sock.close()
+        if conn.file is not None:
+            conn.file.close()
+        if conn in self.connections:
+            self.connections.remove(conn)
+        if conn.connected and conn.code is None:
+            self._event(conn, "dcc_disconnect", [conn.kind])
+
+    def _closeall(self):
+        for conn in list(self.connections):
+            self._close(conn)
+
+    def _on_ctcp(self, cli, ev):
+        if ev.arguments[0] != "DCC" or len(ev.arguments) < 2:
+            return
+        args = ev.arguments[1].split()
+        if args[0].upper() == "CHAT" and len(args) >= 4:
+            if self.accept is None or not self.accept(cli, ev):
+                return
+            try:
+                self.connect_chat(ev.source2, int_to_ip(args[2]),
+                                  int(args[3]))
+            except (OSError, ValueError) as err:
+                print("DCC: Cannot connect to {0}: {1}".format(ev.source,
+                                                               err))
+        elif args[0].upper() == "RESUME" and len(args) >= 4:
+            self._call(self._resume, cli.lower(ev.source), args)
+
+    def _resume(self, nick, args):
+        try:
+            port, position = int(args[2]), int(args[3])
+        except ValueError:
+            return
+        for conn in self.connections:
+            if conn.kind == "send" and conn.port == port and \
+                        not conn.connected and self.cli.lower(conn.nick) == nick:
+                if 0 <= position <= conn.size:
+                    conn.offset = position
+                    self.cli.ctcp("DCC", conn.nick, "ACCEPT {0} {1} {2}"
+                                  .format(args[1], port, position))
+                return
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import array
+import collections
+import re
+
+from bin.client import is_channel
+
+_word_regexp = re.compile(r"\w{2,32}", re.UNICODE)
+
+
+def words(text):
+    """The words of a message as they are indexed.
+
+    >>> sorted(words("Hello, hello world! a"))
+    ['hello', 'world']
+    """
+    return set(_word_regexp.findall(text.lower()))
+
+
+class ChannelHistory(object):
+    """The last messages of a channel in a ring buffer.
+
+    Times and nick ids live in arrays and texts are kept as UTF-8, so a
+    message costs little more than its text. The oldest messages are
+    dropped when there are `size` of them or when their texts take more
+    than `maxbytes`. An inverted index (word -> message numbers) answers
+    searches without looking at every message.
+    """
+    def __init__(self, size=500, maxbytes=65536):
+        self.size = size
+        self.maxbytes = maxbytes
+        self.times = array.array('d', [0.0]) * size
+        self.nicks = array.array('I', [0]) * size
+        self.texts = [None] * size
+        # Message numbers: [first, next) are in the buffer.
+        self.first = 0
+        self.next = 0
+        self.bytes = 0
+        self.index = {}
+
+    def __len__(self):
+        return self.next - self.first
+
+    def add(self, when, nickid, text):
+        """Add a message, return the nick ids of the ones it pushed out
+        (None if it is too long to keep)."""
+        blob = text.encode('utf-8')
+        if len(blob) > self.maxbytes:
+            return None
+        evicted = []
+        while len(self) and (len(self) >= self.size or
+                             self.bytes + len(blob) > self.maxbytes):
+            evicted.append(self._evict())
+        slot = self.next % self.size
+        self.times[slot] = when
+        self.nicks[slot] = nickid
+        self.texts[slot] = blob
+        self.bytes += len(blob)
+        for word in words(text):
+            try:
+                self.index[word].append(self.next)
+            except KeyError:
+                self.index[word] = collections.deque([self.next])
+        self.next += 1
+        return evicted
+
+    def _evict(self):
+        slot = self.first % self.size
+        blob = self.texts[slot]
+        self.texts[slot] = None
+        self.bytes -= len(blob)
+        # Numbers are added in order, so this one is first in its lists.
+        for word in words(blob.decode('utf-8')):
+            seqs = self.index[word]
+            seqs.popleft()
+            if not seqs:
+                del self.index[word]
+        self.first += 1
+        return self.nicks[slot]
+
+    def get(self, seq):
+        """Return (time, nick id, text) of a message number."""
+        slot = seq % self.size
+        return (self.times[slot], self.nicks[slot],
+                self.texts[slot].decode('utf-8'))
+
+    def last(self, count):
+        """The last `count` messages, oldest first."""
+        start = max(self.first, self.next - count)
+        return [self.get(i) for i in range(start, self.next)]
+
+    def search(self, query, limit=3):
+        """The newest messages with every word of query, newest first."""
+        lists = []
+        for word in words(query):
+            if word not in self.index:
+                return []
+            lists.append(self.index[word])
+        if not lists:
+            return []
+        lists.sort(key=len)
+        found = set(lists[0])
+        for seqs in lists[1:]:
+            found.intersection_update(seqs)
+        return [self.get(i) for i in sorted(found, reverse=True)[:limit]]
+
+
+class History(object):
+    """ChannelHistory for every channel, with nicks interned to ids.
+
+    Ids are counted by the messages using them and given to another nick
+    once none does, so the table is no bigger than the buffers.
+
+    >>> h = History(size=2)
+    >>> for i in "abcd":
+    ...     h.add("#c", i, "x", 0)
+    >>> len(h.nickids), h.last("#c")
+    (2, [(0.0, 'c', 'x'), (0.0, 'd', 'x')])
+    """
+    def __init__(self, lower=str.lower, size=500, maxbytes=65536):
+        self.lower = lower
+        self.size = size
+        self.maxbytes = maxbytes
+        self.channels = {}
+        self.nickids = {}
+        self.nicknames = []
+        # Messages using each id, and the ids nobody uses.
+        self.refs = []
+        self.free = []
+
+    def nickid(self, nick):
+        """The id of nick, counting one more message using it."""
+        try:
+            i = self.nickids[nick]
+        except KeyError:
+            if self.free:
+                i = self.free.pop()
+                self.nicknames[i] = nick
+            else:
+                i = len(self.nicknames)
+                self.nicknames.append(nick)
+                self.refs.append(0)
+            self.nickids[nick] = i
+        self.refs[i] += 1
+        return i
+
+    def release(self, i):
+        """A message using nick id i is gone."""
+        self.refs[i] -= 1
+        if self.refs[i] == 0:
+            del self.nickids[self.nicknames[i]]
+            self.nicknames[i] = None
+            self.free.append(i)
+
+    def add(self, channel, nick, text, when):
+        channel = self.lower(channel)
+        try:
+            history = self.channels[channel]
+        except KeyError:
+            history = self.channels[channel] = ChannelHistory(self.size,
+                                                              self.maxbytes)
+        nickid = self.nickid(nick)
+        evicted = history.add(when, nickid, text)
+        if evicted is None:
+            evicted = [nickid]
+        for i in evicted:
+            self.release(i)
+
+    def _named(self, messages):
+        return [(t, self.nicknames[n], text) for t, n, text in messages]
+
+    def last(self, channel, count=3):
+        """Return [(time, nick, text)] of the last messages of a channel."""
+        try:
+            return self._named(self.channels[self.lower(channel)].last(count))
+        except KeyError:
+            return []
+
+    def search(self, channel, query, limit=3):
+        """Return [(time, nick, text)] of the newest messages of a channel
+        with all the words of query."""
+        try:
+            history = self.channels[self.lower(channel)]
+        except KeyError:
+            return []
+        return self._named(history.search(query, limit))
+
+    def on_pubmsg(self, cli, ev):
+        self.add(ev.target, ev.source, ev.arguments[0], ev.time)
+
+    def on_action(self, cli, ev):
+        if not ev.arguments or not is_channel(ev.target):
+            return
+        nick = ev.source.split("!")[0]
+        self.add(ev.target, nick, "* {0} {1}".format(nick, ev.arguments[0]),
+                 ev.time)
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import array
+import collections
+import sys
+import types
+
+# Not followed by deep_size: shared, or not state of ours.
+_skip = (type, types.ModuleType, types.FunctionType, types.MethodType,
+         types.BuiltinFunctionType)
+_containers = (list, tuple, set, frozenset, collections.deque)
+
+
+def deep_size(obj, seen=None):
+    """Estimate the bytes used by obj and everything it holds: container
+    items, dict keys and values, instance attributes. Objects whose id is
+    in seen are not counted (again).
+
+    >>> deep_size([b"x" * 100]) > 100
+    True
+    """
+    if seen is None:
+        seen = set()
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _skip):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (str, bytes, bytearray, int, float, array.array)):
+            continue
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, _containers):
+            stack.extend(obj)
+        if hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+        for name in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, name):
+                stack.append(getattr(obj, name))
+    return size
+
+
+def state_report(cli, extra=None):
+    """Return [(name, count, bytes)] of what a client keeps track of, plus
+    the objects in the extra dict (name -> (count, object)).
+
+    Each structure is measured without what was already counted in the
+    ones before it, and never into the client itself: channels include
+    the users and the ban lists, which are then given on their own.
+    """
+    seen = set([id(cli)])
+    channels = list(cli.channels.values())
+    users = dict((id(u), u) for c in channels for u in c.users.values())
+    res = [
+        ("users", len(users), deep_size(list(users.values()), seen.copy())),
+        ("bans", sum(len(c.banlist) for c in channels),
+                 deep_size([c.banlist for c in channels], seen.copy())),
+        ("channels", len(channels), deep_size(cli.channels, seen)),
+        ("index", len(cli.index), deep_size(cli.index, seen)),
+        ("parked users", len(cli.parked), deep_size(cli.parked, seen)),
+        ("queue", len(cli.queue), deep_size(cli.queue, seen)),
+        ("enrich queue", len(cli.enrich_queue),
+                         deep_size(cli.enrich_queue, seen)),
+        ("linebuffer", len(cli.buffer), deep_size(cli.buffer, seen)),
+        ("casefold cache", len(cli.features._folded),
+                           deep_size(cli.features._folded, seen)),
+    ]
+    for name in sorted(extra or {}):
+        count, obj = extra[name]
+        res.append((name, count, deep_size(obj, seen)))
+    return res
+
+
+class MemoryTracker(object):
+    """tracemalloc snapshots to compare, to find out what grows.
+
+    tracemalloc slows every allocation down, so it only runs between
+    start() and stop().
+    """
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.snapshot = None
+
+    @property
+    def tracing(self):
+        import tracemalloc
+        return tracemalloc.is_tracing()
+
+    def _take(self):
+        import tracemalloc
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def start(self):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.snapshot = self._take()
+
+    def stop(self):
+        import tracemalloc
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def diff(self, count=5):
+        """What grew the most since the last snapshot (or start()), as
+        [(file:line, bytes difference, count difference)]. The new
+        snapshot becomes the one to compare against next time."""
+        snapshot = self._take()
+        stats = snapshot.compare_to(self.snapshot, "lineno")
+        self.snapshot = snapshot
+        return [("{0}:{1}".format(s.traceback[0].filename,
+                                  s.traceback[0].lineno),
+                 s.size_diff, s.count_diff) for s in stats[:count]]
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+import ast
+import importlib
+import os
+import sys
+
+
+class Context(object):
+    """What plugin functions get as their first argument: the shared
+    objects of the bot (acl, plugins, ...).
+
+    Objects that are rarely needed can be given as functions in
+    `factories` (name -> function), they are built the first time they
+    are used.
+    """
+    def __init__(self, factories=None, **kwargs):
+        self.factories = factories or {}
+        self.__dict__.update(kwargs)
+
+    def __getattr__(self, name):
+        # Only called for what isn't there (yet).
+        try:
+            factory = self.__dict__["factories"][name]
+        except KeyError:
+            raise AttributeError(name)
+        value = factory()
+        setattr(self, name, value)
+        return value
+
+    def built(self, name):
+        """The object name if it exists already, None otherwise."""
+        return self.__dict__.get(name)
+
+
+class PluginManager(object):
+    """Commands and event handlers living in the modules of a directory.
+
+    A plugin declares what it has with literals at the top level of its
+    module, which are read with ast without importing it:
+
+        COMMANDS = {"meow": "meow"}            # command -> function
+        HANDLERS = {"join": "on_join"}         # event -> function
+        ROLES = {"raw": ["owner", "admin"]}    # command -> allowed roles
+
+    Functions are called as function(bot, cli, ev), bot being the Context.
+    A plugin is imported the first time one of its commands or handlers is
+    used, and reload() imports the loaded ones again in place.
+    """
+    _index_names = ("COMMANDS", "HANDLERS", "ROLES")
+
+    def __init__(self, path="plugins", package="plugins", context=None):
+        self.path = path
+        self.package = package
+        self.context = context
+        self.cli = None
+        self.modules = {}
+        self.index = {}
+        self.commands = {}
+        self.handlers = {}
+        self._mtimes = {}
+        self._hooked = set()
+        self.scan()
+
+    def scan(self):
+        """Read the index of every plugin whose file changed."""
+        index = {}
+        try:
+            files = sorted(os.listdir(self.path))
+        except OSError:
+            files = []
+        for filename in files:
+            name, ext = os.path.splitext(filename)
+            if ext != ".py" or name.startswith("_"):
+                continue
+            filename = os.path.join(self.path, filename)
+            mtime = os.stat(filename).st_mtime
+            if name in self.index and self._mtimes.get(name) == mtime:
+                index[name] = self.index[name]
+                continue
+            try:
+                index[name] = self._read_index(filename)
+            except (SyntaxError, ValueError) as err:
+                print("PLUGINS: Cannot read {0}: {1}".format(filename, err))
+                continue
+            self._mtimes[name] = mtime
+        self.index = index
+        self.commands = {}
+        self.handlers = {}
+        for name in index:
+            for com, func in index[name]["COMMANDS"].items():
+                roles = index[name]["ROLES"].get(com)
+                self.commands[com.lower()] = (name, func, roles)
+            for evtype, func in index[name]["HANDLERS"].items():
+                self.handlers.setdefault(evtype, []).append((name, func))
+        self._hook()
+
+    def _read_index(self, filename):
+        with open(filename, "rb") as f:
+            tree = ast.parse(f.read(), filename)
+        res = dict((i, {}) for i in self._index_names)
+        for node in tree.body:
+            if not isinstance(node, ast.Assign):
+                continue
+            for target in node.targets:
+                if isinstance(target, ast.Name) and \
+                                            target.id in self._index_names:
+                    res[target.id] = ast.literal_eval(node.value)
+        return res
+
+    def attach(self, cli):
+        """Start dispatching the plugin event handlers of a client."""
+        self.cli = cli
+        self._hook()
+
+    def _hook(self):
+        if self.cli is None:
+            return
+        for evtype in self.handlers:
+            if evtype not in self._hooked:
+                self._hooked.add(evtype)
+                self.cli.addhandler(evtype, self._dispatch)
+
+    def load(self, name):
+        """Import a plugin if it isn't yet and return its module."""
+        try:
+            return self.modules[name]
+        except KeyError:
+            pass
+        module = importlib.import_module(self.package + "." + name)
+        self.modules[name] = module
+        print("PLUGINS: Loaded {0}".format(name))
+        return module
+
+    def reload(self, name=None):
+        """Import again one plugin or every loaded plugin, and pick up new
+        and removed plugins. Returns the names of the reloaded ones."""
+        importlib.invalidate_caches()
+        self.scan()
+        if name is None:
+            names = list(self.modules)
+        else:
+            names = [name]
+        done = []
+        for i in names:
+            if i not in self.index:
+                self.modules.pop(i, None)
+                sys.modules.pop(self.package + "." + i, None)
+                continue
+            if i in self.modules:
+                self.modules[i] = importlib.reload(self.modules[i])
+            else:
+                self.load(i)
+            done.append(i)
+        return done
+
+    def command(self, com):
+        """Return (plugin, function, roles) for a command, or None."""
+        return self.commands.get(com.lower())
+
+    def call(self, plugin, function, cli, ev):
+        return getattr(self.load(plugin), function)(self.context, cli, ev)
+
+    def _dispatch(self, cli, ev):
+        for plugin, function in self.handlers.get(ev.type, ()):
+            try:
+                self.call(plugin, function, cli, ev)
+            except Exception as err:
+                print("PLUGINS: Error in {0}.{1}: {2}".format(plugin,
+                                                            function, err))
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import _thread
+
+from bin.client import IRCClient, is_channel
+
+
+class OutputPool(object):
+    """Helper connections to send more than one connection is allowed to.
+
+    The helpers are clones of the bot with other nicks (JeDaBot1,
+    JeDaBot2...) that only follow the bot in and out of its channels
+    (with their keys). They log in with the bot's SASL settings, on
+    networks that only let identified users speak.
+    Each target is given to the connection that can send to it (the bot,
+    or a helper that is in the channel) with the fewest lines waiting,
+    and keeps it while it can: the lines to a target keep their order
+    while lines to different targets go out in parallel.
+    """
+    def __init__(self, cli, size, nickformat="{0}{1}"):
+        self.cli = cli
+        self.size = size
+        self.nickformat = nickformat
+        self.helpers = []
+        # Helpers that are registered (got the welcome).
+        self.ready = []
+        # Casefolded target -> client sending to it.
+        self.assigned = {}
+        cli.addhandler("join", self._on_join)
+        cli.addhandler("part", self._on_part)
+        cli.addhandler("kick", self._on_kick)
+
+    def start(self):
+        """Connect the helpers, in the background."""
+        if self.helpers:
+            return
+        cli = self.cli
+        for i in range(1, self.size + 1):
+            helper = IRCClient()
+            helper.queue_maxlen = cli.queue_maxlen
+            helper.fallback_encoding = cli.fallback_encoding
+            helper.sasl_mechanism = cli.sasl_mechanism
+            helper.sasl_username = cli.sasl_username
+            helper.sasl_password = cli.sasl_password
+            helper.addhandler("welcome", self._on_welcome)
+            helper.addhandler("disconnect", self._on_disconnect)
+            self.helpers.append(helper)
+            _thread.start_new_thread(helper.connect, (cli.server, cli.port,
+                    self.nickformat.format(cli.nickname, i), cli.username,
+                    cli.gecos, cli.msgdelay, cli.tls, cli.ssl_context))
+
+    def disconnect(self, message="Sayonara <3"):
+        for helper in self.helpers:
+            helper.disconnect(message)
+
+    def route(self, target):
+        """The client to send to target with."""
+        clients = [self.cli]
+        channel = is_channel(target)
+        for helper in self.ready:
+            if not channel or helper.getchannel(target) is not False:
+                clients.append(helper)
+        key = self.cli.lower(target)
+        client = self.assigned.get(key)
+        if client not in clients:
+            client = min(clients, key=lambda c: len(c.queue))
+            if len(self.assigned) >= 1000:
+                self.assigned.clear()
+            self.assigned[key] = client
+        return client
+
+    def privmsg(self, target, msg):
+        self.route(target).privmsg(target, msg)
+
+    def notice(self, target, msg):
+        self.route(target).notice(target, msg)
+
+    def msg(self, target, msg):
+        self.route(target).msg(target, msg)
+
+    def _on_welcome(self, helper, ev):
+        if helper not in self.ready:
+            self.ready.append(helper)
+        for channel in list(self.cli.channels.values()):
+            helper.join(self.cli.channel_key(channel.name))
+
+    def _on_disconnect(self, helper, ev):
+        if helper in self.ready:
+            self.ready.remove(helper)
+
+    def _on_join(self, cli, ev):
+        if cli.is_me(ev.source.nick):
+            for helper in self.ready:
+                helper.join(cli.channel_key(ev.target))
+
+    def _leave(self, channel):
+        for helper in self.ready:
+            if helper.getchannel(channel) is not False:
+                helper.part(channel, "")
+
+    def _on_part(self, cli, ev):
+        if cli.is_me(ev.source.nick):
+            self._leave(ev.target)
+
+    def _on_kick(self, cli, ev):
+        if ev.arguments and cli.is_me(ev.arguments[0]):
+            self._leave(ev.target)
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import collections
+import linecache
+import os
+import re
+import sys
+import threading
+import time
+
+# Where events are dispatched: the frame called from here is a handler.
+_dispatchers = ("_handle_event", "_dispatch")
+# Calls to C don't have a frame, so a thread blocked in recv() or sleep()
+# is seen on the line of Python calling it. Such lines are idle.
+_idle_regexp = re.compile(r"\b(sleep|wait|recv|read|reader|select|accept|"
+                          r"acquire)\(")
+
+
+def _name(code):
+    return "{0}:{1}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class SamplingProfiler(object):
+    """Looks at the stack of every thread `interval` times per second.
+
+    Nothing runs in the profiled threads, so it is cheap enough to start
+    on a bot in production. Samples of threads that were using the CPU
+    are kept as collapsed stacks ("outer;inner;innermost count", what
+    flamegraph.pl reads), the others are only counted in idle.
+    """
+    def __init__(self, interval=0.01, maxdepth=64):
+        self.interval = interval
+        self.maxdepth = maxdepth
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.idle = 0
+        self.started = None
+        self.running = False
+        self.thread = None
+        # Taken by the sampler to add to stacks, and to read it safely.
+        self.lock = threading.Lock()
+        self._idle_lines = {}
+
+    def start(self):
+        """Start sampling, False if it already was."""
+        if self.running:
+            return False
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.idle = 0
+        self.started = time.time()
+        self.running = True
+        self.thread = threading.Thread(target=self._sampler, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Stop sampling, False if it wasn't."""
+        if not self.running:
+            return False
+        self.running = False
+        self.thread.join()
+        return True
+
+    def _is_idle(self, frame):
+        key = (frame.f_code, frame.f_lineno)
+        try:
+            return self._idle_lines[key]
+        except KeyError:
+            line = linecache.getline(frame.f_code.co_filename, frame.f_lineno)
+            idle = self._idle_lines[key] = bool(_idle_regexp.search(line))
+            return idle
+
+    def _sampler(self):
+        me = threading.get_ident()
+        while self.running:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if self._is_idle(frame):
+                    self.idle += 1
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.maxdepth:
+                    stack.append(_name(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                with self.lock:
+                    self.stacks[";".join(stack)] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def snapshot(self):
+        """A copy of stacks, which the sampler may be adding to."""
+        with self.lock:
+            return collections.Counter(self.stacks)
+
+    def dump(self, path):
+        """Write the collapsed stacks to path."""
+        with open(path, "w") as f:
+            for stack, count in self.snapshot().most_common():
+                f.write("{0} {1}\n".format(stack, count))
+
+    def save(self, directory="."):
+        """Dump to a new file in directory and return its path."""
+        path = os.path.join(directory, time.strftime(
+                "profile-%Y%m%d-%H%M%S.txt", time.localtime(self.started)))
+        self.dump(path)
+        return path
+
+    def top(self, count=10):
+        """Return ([(function, samples)] where the time was spent, and
+        [(handler, samples)] of the event handlers including what they
+        called), most samples first."""
+        functions = collections.Counter()
+        handlers = collections.Counter()
+        for stack, samples in self.snapshot().items():
+            frames = stack.split(";")
+            functions[frames[-1]] += samples
+            # Once per stack even if handlers call handlers.
+            inside = set()
+            for i in range(len(frames) - 1):
+                if frames[i].split(":")[1] in _dispatchers:
+                    inside.add(frames[i + 1])
+            for handler in inside:
+                handlers[handler] += samples
+        return functions.most_common(count), handlers.most_common(count)
+
+    def busy(self, function):
+        """Samples with function in the stack."""
+        return sum(n for stack, n in self.snapshot().items()
+                   if ":" + function + ";" in stack + ";")
+
+    def report(self, count=5):
+        """A short text report: top functions and top handlers."""
+        functions, handlers = self.top(count)
+        seconds = (time.time() - self.started) if self.started else 0
+        total = float(self.samples or 1)
+        lines = ["{0} samples in {1:.1f} seconds, {2:.0%} in _processline, "
+                 "{3:.0%} in _handle_event".format(self.samples, seconds,
+                        self.busy("_processline") / total,
+                        self.busy("_handle_event") / total)]
+        for title, top in (("Functions", functions), ("Handlers", handlers)):
+            lines.append("{0}: {1}".format(title, ", ".join(
+                "{0} ({1:.0%})".format(name, n / total)
+                for name, n in top) or "-"))
+        return lines
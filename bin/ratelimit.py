@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import collections
+import time
+
+
+class TokenBucket(object):
+    """Allows `burst` actions at once and then one every `per / burst`
+    seconds.
+
+    >>> b = TokenBucket(2, 60)
+    >>> b.take(), b.take(), b.take()
+    (True, True, False)
+    """
+    def __init__(self, burst, per):
+        self.burst = burst
+        self.rate = burst / float(per)
+        self.tokens = float(burst)
+        self.last = time.time()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) *
+                                                                self.rate)
+        self.last = now
+
+    def take(self, tokens=1):
+        self.refill()
+        if self.tokens < tokens:
+            return False
+        self.tokens -= tokens
+        return True
+
+    def full(self):
+        self.refill()
+        return self.tokens >= self.burst
+
+
+class RateLimiter(object):
+    """One TokenBucket per key (a host, a channel...).
+
+    There are never more than `maxkeys` buckets: when there would be,
+    the ones that filled up again are forgotten, and if that isn't enough
+    (a flood from many keys) the least recently used ones go too, down to
+    three quarters of maxkeys so the next prune is far away.
+
+    >>> r = RateLimiter(1, 60, maxkeys=4)
+    >>> [r.check(i) for i in range(10)] == [True] * 10, len(r.buckets) <= 4
+    (True, True)
+    """
+    def __init__(self, burst, per, maxkeys=1000):
+        self.burst = burst
+        self.per = per
+        self.maxkeys = maxkeys
+        # key -> TokenBucket, least recently used first.
+        self.buckets = collections.OrderedDict()
+
+    def check(self, key, tokens=1):
+        """Take tokens from the bucket of key, False if there were not
+        enough of them."""
+        try:
+            bucket = self.buckets[key]
+            self.buckets.move_to_end(key)
+        except KeyError:
+            if len(self.buckets) >= self.maxkeys:
+                self.prune()
+            bucket = self.buckets[key] = TokenBucket(self.burst, self.per)
+        return bucket.take(tokens)
+
+    def prune(self):
+        for key in [k for k in self.buckets if self.buckets[k].full()]:
+            del self.buckets[key]
+        while len(self.buckets) > self.maxkeys * 3 // 4:
+            self.buckets.popitem(last=False)
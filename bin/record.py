@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Recording of the raw IRC traffic and replay of the recordings.
+
+A capture is an append-only file starting with MAGIC and followed by
+records: a header (time as a double, direction, length) and the line,
+without the CR LF. Next to it, path + ".idx" holds the offset of every
+record as 64-bit integers, so a capture can be opened and indexed without
+reading it all. Passwords we send (PASS, OPER, SASL, NickServ) are
+replaced by *** before they are written.
+
+    python3 -m bin.record capture.rec [--speed N] [--dump]
+"""
+import array
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+MAGIC = b"JDBREC1\n"
+INBOUND = 0
+OUTBOUND = 1
+_header = struct.Struct("<dBI")
+
+# Outbound lines with a secret: (regexp, replacement for it).
+_secrets = [
+    (re.compile(rb"^(PASS|OPER) .*", re.IGNORECASE), rb"\1 ***"),
+    (re.compile(rb"^(AUTHENTICATE) (?!PLAIN$|EXTERNAL$|\*$|\+$).*",
+                re.IGNORECASE), rb"\1 ***"),
+    # Whatever is said to NickServ: identify, register, ghost...
+    (re.compile(rb"^(PRIVMSG NickServ :\S+) .*", re.IGNORECASE), rb"\1 ***"),
+]
+
+
+def redact(line):
+    """Hide the passwords in a line we send.
+
+    >>> redact(b"PRIVMSG NickServ :identify JeDa hunter2")
+    b'PRIVMSG NickServ :identify ***'
+    >>> redact(b"AUTHENTICATE PLAIN"), redact(b"AUTHENTICATE amVkYQ==")
+    (b'AUTHENTICATE PLAIN', b'AUTHENTICATE ***')
+    """
+    for regexp, replacement in _secrets:
+        line, found = regexp.subn(replacement, line)
+        if found:
+            break
+    return line
+
+
+class Recorder(object):
+    """Appends the lines read and sent by an IRCClient to a capture."""
+    def __init__(self, path, flush_every=64):
+        self.path = path
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.data = open(path, "ab")
+        self.index = open(path + ".idx", "ab")
+        if self.data.tell() == 0:
+            self.data.write(MAGIC)
+        self.unflushed = 0
+
+    def record(self, direction, line):
+        with self.lock:
+            offset = self.data.tell()
+            self.data.write(_header.pack(time.time(), direction, len(line)))
+            self.data.write(line)
+            self.index.write(struct.pack("<Q", offset))
+            self.unflushed += 1
+            if self.unflushed >= self.flush_every:
+                self._flush()
+
+    def inbound(self, line):
+        self.record(INBOUND, line)
+
+    def outbound(self, line):
+        self.record(OUTBOUND, redact(line))
+
+    def _flush(self):
+        # Data first: an index entry must never point past the data.
+        self.data.flush()
+        self.index.flush()
+        self.unflushed = 0
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.data.close()
+            self.index.close()
+
+
+class Capture(object):
+    """Read-only view of a capture, memory-mapped.
+
+    capture[i] is (time, direction, line as bytes).
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError("{0} is not a capture".format(path))
+        self.offsets = self._load_index()
+
+    def _load_index(self):
+        offsets = array.array("Q")
+        try:
+            with open(self.path + ".idx", "rb") as f:
+                data = f.read()
+            # Without a half-written last entry.
+            offsets.frombytes(data[:len(data) // 8 * 8])
+        except IOError:
+            offsets = array.array("Q")
+        if offsets.itemsize != 8 or (offsets and
+                                     offsets[-1] >= len(self.map)):
+            offsets = array.array("Q")
+        # Records written after the last index entry (or no index at all).
+        offset = len(MAGIC)
+        if offsets:
+            offset = offsets[-1] + _header.size + \
+                                _header.unpack_from(self.map, offsets[-1])[2]
+        size = len(self.map)
+        while offset + _header.size <= size:
+            length = _header.unpack_from(self.map, offset)[2]
+            if offset + _header.size + length > size:
+                break
+            offsets.append(offset)
+            offset += _header.size + length
+        return offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        offset = self.offsets[i]
+        when, direction, length = _header.unpack_from(self.map, offset)
+        start = offset + _header.size
+        return when, direction, self.map[start:start + length]
+
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self[i]
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def replay(capture, cli, speed=None):
+    """Feed the inbound lines of a capture to cli._processline.
+
+    With a speed the lines come as they were recorded (speed 2 is twice
+    as fast), without one as fast as possible. Returns (lines, seconds).
+    """
+    if not hasattr(cli, "server"):
+        cli.server = "replay"
+        cli.nickname = cli.real_nickname = "JeDaBot"
+    count = 0
+    start = time.time()
+    first = None
+    for when, direction, line in capture:
+        if direction == OUTBOUND:
+            # Keep track of the nick we had.
+            if line[:5] == b"NICK ":
+                cli.nickname = cli.decode(line[5:])
+            continue
+        if speed:
+            if first is None:
+                first = when
+            delay = (when - first) / speed - (time.time() - start)
+            if delay > 0:
+                time.sleep(delay)
+        if line:
+            cli._processline(cli.decode(line))
+            count += 1
+    return count, time.time() - start
+
+
+def main(argv):
+    import argparse
+    from bin.client import IRCClient
+    parser = argparse.ArgumentParser(prog="python3 -m bin.record",
+                            description="Replay or dump a traffic capture.")
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=None,
+                        help="replay at the recorded pace times SPEED "
+                             "(default: as fast as possible)")
+    parser.add_argument("--dump", action="store_true",
+                        help="print the capture instead of replaying it")
+    args = parser.parse_args(argv)
+    capture = Capture(args.capture)
+    if args.dump:
+        for when, direction, line in capture:
+            print("{0:.3f} {1} {2}".format(when, "<>"[direction],
+                                   line.decode("utf-8", "replace")))
+        return 0
+    count, seconds = replay(capture, IRCClient(), args.speed)
+    print("Replayed {0} lines in {1:.3f} seconds ({2:.0f} lines/s)".format(
+                                count, seconds, count / (seconds or 1e-9)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
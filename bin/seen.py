@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import threading
+import time
+
+
+class SeenDB(object):
+    """When and where every nick was seen for the last time, in SQLite.
+
+    Events only update a dict in memory; a background thread writes what
+    changed every `interval` seconds in a single transaction, so a
+    netsplit with thousands of QUITs doesn't mean thousands of writes on
+    the thread reading from the server.
+    """
+    def __init__(self, path, lower=str.lower, interval=5):
+        self.path = path
+        self.lower = lower
+        self.interval = interval
+        self.pending = {}
+        # What is being written right now.
+        self.flushing = {}
+        self.lock = threading.Lock()
+        self.dblock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (nick TEXT PRIMARY "
+                        "KEY, name TEXT, time REAL, action TEXT, "
+                        "channel TEXT, text TEXT)")
+        self.db.commit()
+        self.running = True
+        self.thread = threading.Thread(target=self._flusher, daemon=True)
+        self.thread.start()
+
+    def update(self, nick, when, action, channel=None, text=None):
+        """Remember that nick did action (said, joined, parted, quit,
+        nickto, nickfrom) on channel at when."""
+        with self.lock:
+            self.pending[self.lower(nick)] = (nick, when, action, channel,
+                                              text)
+
+    def lookup(self, nick):
+        """Return (nick, time, action, channel, text) or None."""
+        key = self.lower(nick)
+        with self.lock:
+            for i in (self.pending, self.flushing):
+                if key in i:
+                    return i[key]
+        with self.dblock:
+            return self.db.execute("SELECT name, time, action, channel, text "
+                            "FROM seen WHERE nick = ?", (key,)).fetchone()
+
+    def flush(self):
+        """Write what changed since the last time, return how many."""
+        with self.dblock:
+            with self.lock:
+                self.flushing, self.pending = self.pending, {}
+            rows = [(key,) + self.flushing[key] for key in self.flushing]
+            try:
+                if rows:
+                    with self.db:
+                        self.db.executemany("INSERT OR REPLACE INTO seen "
+                                            "VALUES (?, ?, ?, ?, ?, ?)", rows)
+            except sqlite3.Error:
+                # Try again next time, unless something newer came in.
+                with self.lock:
+                    for key in self.flushing:
+                        self.pending.setdefault(key, self.flushing[key])
+                raise
+            finally:
+                with self.lock:
+                    self.flushing = {}
+        return len(rows)
+
+    def _flusher(self):
+        while self.running:
+            time.sleep(self.interval)
+            if not self.running:
+                return
+            try:
+                self.flush()
+            except sqlite3.Error as err:
+                print("SEEN: Cannot save to {0}: {1}".format(self.path, err))
+
+    def close(self):
+        self.running = False
+        self.flush()
+        self.db.close()
+
+    def on_pubmsg(self, cli, ev):
+        self.update(ev.source, ev.time, "said", ev.target, ev.arguments[0])
+
+    def on_join(self, cli, ev):
+        self.update(ev.source.nick, ev.time, "joined", ev.target)
+
+    def on_part(self, cli, ev):
+        self.update(ev.source.nick, ev.time, "parted", ev.target,
+                    ev.arguments[0] if ev.arguments else None)
+
+    def on_quit(self, cli, ev):
+        self.update(ev.source.nick, ev.time, "quit", None,
+                    ev.arguments[0] if ev.arguments else None)
+
+    def on_nick(self, cli, ev):
+        self.update(ev.source.nick, ev.time, "nickto", None, ev.target)
+        self.update(ev.target, ev.time, "nickfrom", None, ev.source.nick)
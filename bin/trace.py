@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+import collections
+import itertools
+import threading
+import time
+
+# (name, from stage, to stage) of the intervals measured. The stages are:
+# read (the data came from the socket), parsed (by _processline), command
+# (a command handler starts the command), queued (the reply went to
+# IRCClient.send), sent (and to the socket) and done (every handler of
+# the line returned).
+INTERVALS = [
+    ("parse", "read", "parsed"),
+    ("dispatch", "parsed", "command"),
+    ("command", "command", "queued"),
+    ("queue", "queued", "sent"),
+    ("handlers", "parsed", "done"),
+    ("reply", "read", "sent"),
+]
+
+
+def percentile(values, p):
+    """The p-th percentile (0-100) of a sorted list, nearest rank.
+
+    >>> percentile([1, 2, 3, 4], 50), percentile([1, 2, 3, 4], 100)
+    (2, 4)
+    """
+    if not values:
+        return None
+    return values[max(0, int(round(p / 100.0 * len(values))) - 1)]
+
+
+class Trace(object):
+    __slots__ = ("id", "stamps")
+
+    def __init__(self, id, when):
+        self.id = id
+        self.stamps = {"read": when}
+
+
+class TracedLine(str):
+    """A line queued to be sent, carrying the Trace that caused it."""
+    trace = None
+
+
+class Tracer(object):
+    """Follows every line read from the server until the replies it
+    caused are sent, and keeps the last `size` durations of every
+    interval in INTERVALS.
+
+    The trace of the line being processed is kept per thread, as handlers
+    run in the thread reading from the server. Queued lines take their
+    trace with them (TracedLine), so identical lines don't get mixed up.
+    """
+    def __init__(self, size=1000):
+        self.size = size
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        # Held to add durations and to copy them.
+        self.lock = threading.Lock()
+        self.durations = dict((name, collections.deque(maxlen=size))
+                              for name, start, end in INTERVALS)
+
+    def begin(self, when):
+        """Start the trace of a line read at when."""
+        trace = self.local.trace = Trace(next(self.ids), when)
+        return trace
+
+    def current(self):
+        """The trace of the line this thread is processing, or None."""
+        return getattr(self.local, "trace", None)
+
+    def mark(self, stage, trace=None):
+        """Record that the current trace (or trace) reached stage, unless
+        it did already."""
+        if trace is None:
+            trace = self.current()
+        if trace is None or stage in trace.stamps:
+            return
+        now = trace.stamps[stage] = time.time()
+        with self.lock:
+            for name, start, end in INTERVALS:
+                if end == stage and start in trace.stamps:
+                    self.durations[name].append(now - trace.stamps[start])
+
+    def end(self):
+        self.mark("done")
+        self.local.trace = None
+
+    def queued(self, line):
+        """Return line to be queued, as a TracedLine if this thread is
+        processing a traced line."""
+        trace = self.current()
+        if trace is None:
+            return line
+        self.mark("queued", trace)
+        line = TracedLine(line)
+        line.trace = trace
+        return line
+
+    def sent(self, line):
+        trace = getattr(line, "trace", None)
+        if trace is not None:
+            self.mark("sent", trace)
+
+    def report(self):
+        """[(interval, count, p50, p90, p99, max)] in seconds."""
+        with self.lock:
+            durations = dict((name, list(self.durations[name]))
+                             for name in self.durations)
+        res = []
+        for name, start, end in INTERVALS:
+            values = sorted(durations[name])
+            if not values:
+                continue
+            res.append((name, len(values), percentile(values, 50),
+                        percentile(values, 90), percentile(values, 99),
+                        values[-1]))
+        return res
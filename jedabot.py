@@ -1,89 +1,201 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
+import time
 
-__version__ = "1.0"
+# When each startup phase ended, see main().
+startup = {"launch": time.time()}
 
-print("JeDaBot {}\nThe smart people are the ones who fails. Without fails, people are morons.\n".format(__version__))
+__version__ = "1.0"
 
-from bin.client import IRCClient
-import random
+from bin.client import IRCClient, make_ssl_context, certificate_fingerprint
+from bin.acl import ACL
+from bin.plugins import Context, PluginManager
+from bin.ratelimit import RateLimiter
+import codecs
+import importlib
+import importlib.util
+import os
 import re
 import signal
 import sys
-import time
-try:
-    from conf.configuration import *
-except ImportError:
-    print('JeDaBot cannot found configuration.py - Please rename configuration.py.example to configuration.py on the conf folder and edit it.')
-    sys.exit(1)
-except Exception as err:
-    print('JeDaBot cannot load the configuration: {}'.format(err))
-    sys.exit(1)
 
-irc = IRCClient()
+startup["imports"] = time.time()
 
-def ctcphandler(cli, ev):
-    if ev.arguments[0] == "PING":
-        cli.ctcp_reply(ev.source, "PING " + ev.arguments[1])
-    elif ev.arguments[0] == "USERINFO":
-        cli.ctcp_reply(ev.source, "USERINFO {}, a bot with JeDaBot's brain.".format(cli.nickname))
-    elif ev.arguments[0] == "VERSION":
-        cli.ctcp_reply(ev.source, "VERSION JeDaBot {}".format(__version__))
+# Seconds the imports above may take before startup complains about it.
+IMPORT_BUDGET = 0.1
+
+# Defaults for settings older configuration files may not have.
+DEFAULTS = {
+    "SSL": False,
+    "SSL_VERIFY": True,
+    "SSL_CERTFILE": "",
+    "SSL_KEYFILE": "",
+    "SASL": "",
+    "ROLES": {},
+    "USER_RATELIMIT": (5, 30),
+    "CHANNEL_RATELIMIT": (10, 30),
+    "OUTPUT_QUEUE": 100,
+    "HISTORY": {},
+    "SEEN_DB": "",
+    "RECORD": "",
+    "PROFILE_DIR": ".",
+    "TRACE": False,
+    "POOL": 0,
+    "DCC": False,
+    "DCC_HOST": "",
+    "DCC_PORTS": (0, 0),
+    "DCC_DIR": "",
+    "CTCP_RATELIMIT": (3, 60),
+    "CTCP_GLOBAL_RATELIMIT": (10, 30),
+    "CTCP_IGNORE": 300,
+    "ENCODING_FALLBACK": "cp1252",
+    "CHANNEL_ENCODINGS": {},
+}
+
+# Set up by main().
+config_path = None
+config = irc = acl = bot = plugins = None
+# Ids of the commandhandler subscriptions to channel messages.
+public_commands = []
+matchers = userlimit = channellimit = None
+
+def load_config(path=None):
+    """Read conf/configuration.py, or the file at path, (again if it was
+    already read) and return its settings, with DEFAULTS for the missing
+    ones."""
+    if path is not None:
+        spec = importlib.util.spec_from_file_location("configuration", path)
+        if spec is None:
+            raise ImportError("{} is not a Python file".format(path))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    elif "conf.configuration" not in sys.modules:
+        module = importlib.import_module("conf.configuration")
+    else:
+        module = importlib.reload(sys.modules["conf.configuration"])
+    config = Context(**DEFAULTS)
+    for name in dir(module):
+        if name.isupper():
+            setattr(config, name, getattr(module, name))
+    if not config.ROLES:
+        # Older configurations only name the owner and the admins, they
+        # are taken as services accounts (not nicks, anybody can use one).
+        config.ROLES = {"owner": ["$a:" + config.OWNER],
+                        "admin": ["$a:" + i for i in config.ADMINS]}
+    # Unknown encodings would only fail when a line needs them.
+    for i in [config.ENCODING_FALLBACK] + list(config.CHANNEL_ENCODINGS.values()):
+        codecs.lookup(i)
+    return config
+
+def set_encodings(cli, config):
+    cli.fallback_encoding = config.ENCODING_FALLBACK
+    cli.channel_encodings = dict((cli.lower(k), v) for k, v in
+                                 config.CHANNEL_ENCODINGS.items())
+
+def set_login(cli, config):
+    """Set the SASL settings, used from the next registration on, and
+    return the TLS context for the configuration (None without SSL)."""
+    if config.SASL:
+        cli.sasl_mechanism = config.SASL.upper()
+        cli.sasl_username = config.USERNAME or config.NICK
+        cli.sasl_password = config.PASS
+    else:
+        cli.sasl_mechanism = None
+    if config.SSL:
+        return make_ssl_context(config.SSL_VERIFY, config.SSL_CERTFILE or None,
+                                config.SSL_KEYFILE or None)
+    return None
+
+def build_matchers(prefix):
+    """Compile the command regexps for a PREFIX (a string or a list):
+    one per prefix for channels, and one with optional prefixes for
+    private messages."""
+    if isinstance(prefix, str):
+        prefix = [prefix]
+    public = [re.compile("^" + re.escape(i) + "(\S{1,52})[ ]?(.*)",
+                         re.IGNORECASE) for i in prefix]
+    private = re.compile("^(?:" + "|".join(re.escape(i) for i in prefix) +
+                         ")?(\S{1,52})[ ]?(.*)", re.IGNORECASE)
+    return public, private
 
 def welcomehandler(cli, ev):
-    if PASS != "":
-        if USERNAME == "":
-            authuser = NICK
+    if "registered" not in startup:
+        startup["registered"] = time.time()
+        print("Registered {:.3f} seconds after launch".format(
+                              startup["registered"] - startup["launch"]))
+    # With a client certificate services identify us by its fingerprint.
+    if config.PASS != "" and not cli.sasl_authenticated and \
+                            not (config.SSL and config.SSL_CERTFILE):
+        if config.USERNAME == "":
+            authuser = config.NICK
         else:
-            authuser = USERNAME
-        cli.privmsg("NickServ", "identify {} {}".format(authuser, PASS))
-    for val in CHANNELS:
+            authuser = config.USERNAME
+        cli.privmsg("NickServ", "identify {} {}".format(authuser, config.PASS))
+    for val in config.CHANNELS:
         cli.join(val)
+    if bot.pool is not None:
+        bot.pool.start()
+
+def new_ctcp():
+    from bin.ctcp import CTCPResponder
+    return CTCPResponder(__version__, config.CTCP_RATELIMIT,
+                         config.CTCP_GLOBAL_RATELIMIT, config.CTCP_IGNORE)
+
+def new_profiler():
+    from bin.profiler import SamplingProfiler
+    return SamplingProfiler()
+
+def new_memory():
+    from bin.memory import MemoryTracker
+    return MemoryTracker()
+
+def ctcphandler(cli, ev):
+    bot.ctcp.on_ctcp(cli, ev)
 
 def invited(cli, ev):
     cli.join(ev.arguments[0])
     
 def _iscommand(ev):
+    public, private = matchers
     if ev.type == "pubmsg":
-        try:
-            x = PREFIX
-            if isinstance(x, list):
-                for i in x:
-                    p1 = re.compile("^" + re.escape(i) +
-                        "(\S{1,52})[ ]?(.*)", re.IGNORECASE)
-                    m1 = p1.search(ev.arguments[0])
-                    if m1 is not None:
-                        return m1
-            elif isinstance(x, str):
-                p1 = re.compile("^" + re.escape(x) +
-                    "(\S{1,52})[ ]?(.*)", re.IGNORECASE)
-                m1 = p1.search(ev.arguments[0])
-                if m1 is not None and x != "":
-                    return m1
-        except:
-            pass
-        p1 = re.compile("^" + re.escape(PREFIX) +
-            "(\S{1,52})[ ]?(.*)", re.IGNORECASE)
-    else:
-        p1 = re.compile("^(?:" + re.escape(PREFIX) +
-            ")?(\S{1,52})[ ]?(.*)", re.IGNORECASE)
-    m1 = p1.search(ev.arguments[0])
-    return m1
+        for p1 in public:
+            m1 = p1.search(ev.arguments[0])
+            if m1 is not None:
+                return m1
+        return None
+    return private.search(ev.arguments[0])
+
+_nick_matcher = [None, None]
+
+def _isaddressed(cli, ev):
+    # Compiled again only when our nick changes.
+    if _nick_matcher[0] != cli.nickname:
+        _nick_matcher[1] = re.compile("^" + re.escape(cli.nickname) +
+            "[:, ]? (\S{1,52})[ ]?(.*)", re.IGNORECASE)
+        _nick_matcher[0] = cli.nickname
+    return _nick_matcher[1].search(ev.arguments[0])
 
-def is_staff(nick):
-    if nick == OWNER:
+def is_staff(ev):
+    return acl.check(ev.source2, "owner", "admin")
+
+def _ratelimited(cli, ev):
+    """Take a token for the user (by host) and for the channel. Staff
+    isn't limited."""
+    if is_staff(ev):
+        return False
+    try:
+        user = cli.lower(ev.source2.host)
+    except (AttributeError, IndexError):
+        user = cli.lower(ev.source)
+    if not userlimit.check(user):
         return True
-    elif nick in ADMINS:
+    if ev.type == "pubmsg" and not channellimit.check(cli.lower(ev.target)):
         return True
-    else:
-        return False
+    return False
 
 def commandhandler(cli, ev):
     m1 = _iscommand(ev)
-
-    p2 = re.compile("^" + re.escape(cli.nickname) +
-        "[:, ]? (\S{1,52})[ ]?(.*)", re.IGNORECASE)
-    m2 = p2.search(ev.arguments[0])
+    m2 = _isaddressed(cli, ev)
     if not m1 is None:
         try:
             del ev.splitd[0]
@@ -95,70 +207,297 @@ def commandhandler(cli, ev):
         del ev.splitd[0]
         com = m2.group(1)
 
-    if not m1 is None or not m2 is None:
-        if com == "raw":
-            if is_staff(ev.source):
-                cli.send(" ".join(ev.splitd))
-            else:
-                cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
-        elif com == "join":
-            if is_staff(ev.source):
-                cli.send("JOIN " + ev.splitd[0])
-            else:
-                cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
-        elif com == "part":
-            if is_staff(ev.source):
-                cli.send("PART " + ev.splitd[0])
-            else:
-                cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
-        elif com == "disconnect" or com == "quit":
-            if is_staff(ev.source):
-                cli.disconnect(" ".join(ev.splitd))
-                sys.exit(0)
-            else:
-                cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
-        elif com == "reconnect":
-            if is_staff(ev.source):
-                cli.quit(" ".join(ev.splitd))
-            else:
-                cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
-        elif com == "msg":
-            if is_staff(ev.source):
-                cli.privmsg(ev.splitd[0], " ".join(ev.splitd).replace(ev.splitd[0] + " ", ""))
-            else:
-                cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
-        elif com == "notice":
-            if is_staff(ev.source):
-                cli.notice(ev.splitd[0], " ".join(ev.splitd).replace(ev.splitd[0] + " ", ""))
-            else:
-                cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
-        elif com == "meow":
-            cli.msg(ev.target, random.choice(["“I’m trying to translate what my cat says and put it in a book, but how many homonyms are there for meow?” ― Jarod Kintz", "“I want to start a business making mint-flavored sunshine that comes in a can half full of meow-free rainbows. (Leprechauns sold separately.)” ― Jarod Kintz", "“Chairs have legs. Four of them, like my father. Meow.” ― Jarod Kintz", "“Be honest because you stole it, not because blue/green/yell a little yellow. Dandelions just don’t meow like regular lions.” ― Jarod Kintz", "“I have a bedroom rug that I feed. It’s not very flat, and it meows when I step on it.” ― Jarod Kintz", "“I bought you a box of karate chops, but it could be dangerous to open it with a knife. And cats are masters at getting into boxes, so here, try opening it with my portable meow maker. ” ― Jarod Kintz", "“Some dogs look like giant mustaches. I shaved mine off because it was barking too much. My love life has improved by leaps and meows.” ― Jarod Kintz"]))
+    if m1 is None and m2 is None:
+        return
+    command = plugins.command(com)
+    if command is None and com != "reload":
+        # Not a command (in private every line looks like one), so it
+        # doesn't cost a token either.
+        return
+    if _ratelimited(cli, ev):
+        # Answering would only help them flood.
+        return
+    if cli.tracer is not None:
+        cli.tracer.mark("command")
+    if com == "reload":
+        if not is_staff(ev):
+            cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
+            return
+        name = ev.splitd[0] if ev.splitd else None
+        try:
+            done = plugins.reload(name)
+        except Exception as err:
+            cli.msg(ev.target, "{}: Reload failed: {}".format(ev.source, err))
+            return
+        cli.msg(ev.target, "{}: Reloaded {}".format(ev.source,
+                                                ", ".join(done) or "nothing"))
+        return
+    plugin, function, roles = command
+    if roles and not acl.check(ev.source2, *roles):
+        cli.msg(ev.target, ev.source + ": STOP DREAMING YOU FREAK?!?!??!?!??!?!?")
+        return
+    plugins.call(plugin, function, cli, ev)
+
+def dcccommandhandler(cli, ev):
+    # Only staff get a DCC CHAT, and the replies don't go through the
+    # server, so no flood limits for them.
+    from bin.dcc import DCCClient
+    commandhandler(DCCClient(cli, ev.dcc), ev)
+
+def rehash(signum=None, frame=None):
+    """Read the configuration again and apply what changed without
+    reconnecting: channels, command prefixes and roles."""
+    global config, matchers, userlimit, channellimit
+    print("\nReloading the configuration...")
+    try:
+        new = load_config(config_path)
+        newmatchers = build_matchers(new.PREFIX)
+    except Exception as err:
+        print("Cannot reload the configuration, keeping the old one: {}"
+              .format(err))
+        return
+    # Entries are "#channel" or "#channel key", keyed by the name alone.
+    old = dict((irc.lower(i.split(" ", 1)[0]), i) for i in config.CHANNELS)
+    joined = dict((irc.lower(i.split(" ", 1)[0]), i) for i in new.CHANNELS)
+    with irc.handlerlock:
+        for i in joined:
+            if i not in old:
+                irc.join(joined[i])
+            elif joined[i] != old[i]:
+                # Only the key changed, it is used when we join again.
+                key = joined[i].split(" ", 1)[1:]
+                if key:
+                    irc.channel_keys[i] = key[0]
+                else:
+                    irc.channel_keys.pop(i, None)
+        for i in old:
+            if i not in joined and irc.getchannel(i) is not False:
+                irc.part(old[i].split(" ", 1)[0],
+                         "Not in my configuration anymore")
+        matchers = newmatchers
+        if new.PREFIX != config.PREFIX:
+            for i in public_commands:
+                irc.filterhandler(i, prefix=new.PREFIX, addressed=True)
+        acl.load(new.ROLES)
+        if new.USER_RATELIMIT != config.USER_RATELIMIT:
+            userlimit = RateLimiter(*new.USER_RATELIMIT)
+        if new.CHANNEL_RATELIMIT != config.CHANNEL_RATELIMIT:
+            channellimit = RateLimiter(*new.CHANNEL_RATELIMIT)
+    ctcplimits = ["CTCP_RATELIMIT", "CTCP_GLOBAL_RATELIMIT", "CTCP_IGNORE"]
+    if bot.built("ctcp") is not None and [getattr(new, i) for i in ctcplimits] \
+                                != [getattr(config, i) for i in ctcplimits]:
+        bot.ctcp.set_limits(new.CTCP_RATELIMIT, new.CTCP_GLOBAL_RATELIMIT,
+                            new.CTCP_IGNORE)
+    irc.queue_maxlen = irc.queue.maxlen = new.OUTPUT_QUEUE
+    set_encodings(irc, new)
+    if not new.TRACE:
+        irc.tracer = None
+    elif irc.tracer is None:
+        from bin.trace import Tracer
+        irc.tracer = Tracer()
+    def changed(*names):
+        return [i for i in names
+                if getattr(new, i, None) != getattr(config, i, None)]
+    if changed("NICK"):
+        irc.nick(new.NICK)
+    connection = changed("HOST", "PORT", "IDENT", "REALNAME", "SSL",
+                         "SSL_VERIFY", "SSL_CERTFILE", "SSL_KEYFILE", "SASL",
+                         "USERNAME", "PASS")
+    if connection:
+        irc.reconnect_to = (new.HOST, new.PORT, new.NICK, new.IDENT,
+                            new.REALNAME, irc.msgdelay, new.SSL,
+                            set_login(irc, new))
+        print("{} changed, it will be used when reconnecting".format(
+                                                      ", ".join(connection)))
+    for i in changed("POOL", "DCC"):
+        print("{} changed, restart the bot to apply it".format(i))
+    config = bot.config = new
+    print("Configuration reloaded")
+
+def profile_signal(signum, frame):
+    """SIGUSR1 starts the profiler, SIGUSR2 stops it and saves what it
+    found to PROFILE_DIR."""
+    if signum == signal.SIGUSR1:
+        if bot.profiler.start():
+            print("PROFILE: Started")
+        return
+    if not bot.profiler.stop():
+        return
+    try:
+        print("PROFILE: Saved to {}".format(
+                                     bot.profiler.save(config.PROFILE_DIR)))
+    except IOError as err:
+        print("PROFILE: Cannot save the profile: {}".format(err))
+    for line in bot.profiler.report():
+        print("PROFILE: " + line)
 
 def signal_handler(signum, frame):
     signals = dict((getattr(signal, n), n) for n in dir(signal) if n.startswith('SIG') and '_' not in n )
     print('\nReceived {}\n'.format(signals[signum]))
     irc.disconnect('Received {}'.format(signals[signum]))
+    if bot.pool is not None:
+        bot.pool.disconnect('Received {}'.format(signals[signum]))
+    if bot.seen is not None:
+        bot.seen.close()
+    if irc.recorder is not None:
+        irc.recorder.close()
     sys.exit(0)
 
-irc.addhandler("ctcp", ctcphandler)
-irc.addhandler("invite", invited)
-irc.addhandler("privmsg", commandhandler)
-irc.addhandler("pubmsg", commandhandler)
-irc.addhandler("privnotice", commandhandler)
-irc.addhandler("pubnotice", commandhandler)
-irc.addhandler("welcome", welcomehandler)
-try:
-    irc.connect(HOST, PORT, NICK, IDENT, REALNAME)
-except:
-    print("\nError trying to connect. Exiting...")
-    sys.exit(1)
-            
-signal.signal(signal.SIGTERM, signal_handler)
-signal.signal(signal.SIGUSR1, signal_handler)
-signal.signal(signal.SIGHUP, signal_handler)
-signal.signal(signal.SIGINT, signal_handler)
-
-while True:
-    time.sleep(0.1) 
+def setup(dry_run=False):
+    """Build the client and everything around it from the configuration
+    and register the handlers. Optional subsystems are only imported
+    when they are enabled. Nothing is opened with dry_run."""
+    global irc, acl, bot, plugins, matchers, userlimit, channellimit, \
+           public_commands
+    irc = IRCClient()
+    matchers = build_matchers(config.PREFIX)
+    userlimit = RateLimiter(*config.USER_RATELIMIT)
+    channellimit = RateLimiter(*config.CHANNEL_RATELIMIT)
+    irc.queue_maxlen = config.OUTPUT_QUEUE
+    set_encodings(irc, config)
+    acl = ACL(irc, config.ROLES)
+    # Built when first used.
+    factories = {"ctcp": new_ctcp, "profiler": new_profiler,
+                 "memory": new_memory}
+    bot = Context(factories, acl=acl, config=config, history=None, seen=None,
+                  pool=None, dcc=None)
+    bot.plugins = plugins = PluginManager(os.path.join(
+                         os.path.dirname(os.path.abspath(__file__)), "plugins"),
+                         context=bot)
+    plugins.attach(irc)
+
+    irc.addhandler("ctcp", ctcphandler)
+    irc.addhandler("invite", invited)
+    # In channels only what starts with a prefix or our nick can be a
+    # command, the rest never gets to commandhandler.
+    irc.addhandler("privmsg", commandhandler)
+    public_commands = [irc.addhandler("pubmsg", commandhandler,
+                                      prefix=config.PREFIX, addressed=True)]
+    irc.addhandler("privnotice", commandhandler)
+    public_commands.append(irc.addhandler("pubnotice", commandhandler,
+                                          prefix=config.PREFIX, addressed=True))
+    irc.addhandler("welcome", welcomehandler)
+    if config.HISTORY:
+        from bin.history import History
+        bot.history = History(irc.lower, **config.HISTORY)
+        irc.addhandler("pubmsg", bot.history.on_pubmsg)
+        irc.addhandler("action", bot.history.on_action)
+    if config.RECORD and not dry_run:
+        from bin.record import Recorder
+        irc.recorder = Recorder(config.RECORD)
+    if config.POOL and not dry_run:
+        from bin.pool import OutputPool
+        bot.pool = OutputPool(irc, config.POOL)
+    if config.TRACE:
+        from bin.trace import Tracer
+        irc.tracer = Tracer()
+    if config.DCC and not dry_run:
+        from bin.dcc import DCCManager
+        bot.dcc = DCCManager(irc, config.DCC_HOST or None, config.DCC_PORTS,
+                             accept=lambda cli, ev: is_staff(ev))
+        irc.addhandler("dccmsg", dcccommandhandler)
+    if config.SEEN_DB and not dry_run:
+        from bin.seen import SeenDB
+        bot.seen = SeenDB(config.SEEN_DB, irc.lower)
+        for i in ["pubmsg", "join", "part", "quit", "nick"]:
+            irc.addhandler(i, getattr(bot.seen, "on_" + i))
+    irc.ssl_context = set_login(irc, config)
+    if config.SSL and config.SSL_CERTFILE:
+        print("Client certificate fingerprint: {}".format(
+                              certificate_fingerprint(config.SSL_CERTFILE)))
+
+def startup_report():
+    """Print how long each startup phase took."""
+    last = startup["launch"]
+    for phase in ["imports", "config", "setup", "connect", "registered"]:
+        if phase in startup:
+            print("STARTUP: {:<10} {:7.3f}s".format(phase,
+                                                    startup[phase] - last))
+            last = startup[phase]
+    print("STARTUP: {:<10} {:7.3f}s".format("total",
+                                            last - startup["launch"]))
+
+def parse_args(argv):
+    import argparse
+    parser = argparse.ArgumentParser(prog="jedabot.py",
+                                     description="JeDaBot, an IRC bot.")
+    parser.add_argument("--config", metavar="PATH", default=None,
+                        help="configuration file to use instead of "
+                             "conf/configuration.py")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="load the configuration and the plugins, "
+                             "then exit without connecting")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="print where the startup time goes")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    global config, config_path
+    args = parse_args(argv)
+    print("JeDaBot {}\nThe smart people are the ones who fails. Without fails, people are morons.\n".format(__version__))
+    imports = startup["imports"] - startup["launch"]
+    if imports > IMPORT_BUDGET:
+        print("STARTUP: Imports took {:.3f}s, over the budget of {:.3f}s"
+              .format(imports, IMPORT_BUDGET))
+    if args.profile_startup:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    config_path = args.config
+    try:
+        config = load_config(config_path)
+    except (ImportError, IOError) as err:
+        if config_path is None:
+            print('JeDaBot cannot found configuration.py - Please rename configuration.py.example to configuration.py on the conf folder and edit it.')
+        else:
+            print('JeDaBot cannot read {}: {}'.format(config_path, err))
+        return 1
+    except Exception as err:
+        print('JeDaBot cannot load the configuration: {}'.format(err))
+        return 1
+    startup["config"] = time.time()
+
+    try:
+        setup(args.dry_run)
+    except Exception as err:
+        print("JeDaBot cannot start: {}".format(err))
+        return 1
+    startup["setup"] = time.time()
+
+    if not args.dry_run:
+        try:
+            irc.connect(config.HOST, config.PORT, config.NICK, config.IDENT,
+                        config.REALNAME, tls=config.SSL)
+        except:
+            print("\nError trying to connect. Exiting...")
+            return 1
+        startup["connect"] = time.time()
+
+    if args.profile_startup:
+        import pstats
+        profiler.disable()
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+    if args.dry_run:
+        print("Configuration and plugins loaded: {} commands, {} channels"
+              .format(len(plugins.commands), len(config.CHANNELS)))
+        if args.profile_startup:
+            startup_report()
+        return 0
+
+    signal.signal(signal.SIGTERM, signal_handler)
+    signal.signal(signal.SIGUSR1, profile_signal)
+    signal.signal(signal.SIGUSR2, profile_signal)
+    signal.signal(signal.SIGHUP, rehash)
+    signal.signal(signal.SIGINT, signal_handler)
+
+    reported = not args.profile_startup
+    while True:
+        time.sleep(0.1)
+        if not reported and "registered" in startup:
+            startup_report()
+            reported = True
+
+if __name__ == "__main__":
+    sys.exit(main()) 
 
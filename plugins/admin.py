@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+import sys
+
+from bin.memory import state_report
+
+COMMANDS = {
+    "raw": "raw",
+    "join": "join",
+    "part": "part",
+    "disconnect": "disconnect",
+    "quit": "disconnect",
+    "reconnect": "reconnect",
+    "msg": "msg",
+    "notice": "notice",
+    "profile": "profile",
+    "latency": "latency",
+    "memory": "memory",
+    "announce": "announce",
+}
+ROLES = {
+    "raw": ["owner", "admin"],
+    "join": ["owner", "admin"],
+    "part": ["owner", "admin"],
+    "disconnect": ["owner", "admin"],
+    "quit": ["owner", "admin"],
+    "reconnect": ["owner", "admin"],
+    "msg": ["owner", "admin"],
+    "notice": ["owner", "admin"],
+    "profile": ["owner", "admin"],
+    "latency": ["owner", "admin"],
+    "memory": ["owner", "admin"],
+    "announce": ["owner", "admin"],
+}
+
+
+def raw(bot, cli, ev):
+    cli.send(" ".join(ev.splitd))
+
+def join(bot, cli, ev):
+    cli.send("JOIN " + ev.splitd[0])
+
+def part(bot, cli, ev):
+    cli.send("PART " + ev.splitd[0])
+
+def disconnect(bot, cli, ev):
+    cli.disconnect(" ".join(ev.splitd))
+    sys.exit(0)
+
+def reconnect(bot, cli, ev):
+    cli.quit(" ".join(ev.splitd))
+
+def msg(bot, cli, ev):
+    cli.privmsg(ev.splitd[0], " ".join(ev.splitd).replace(ev.splitd[0] + " ", ""))
+
+def notice(bot, cli, ev):
+    cli.notice(ev.splitd[0], " ".join(ev.splitd).replace(ev.splitd[0] + " ", ""))
+
+def profile(bot, cli, ev):
+    action = ev.splitd[0].lower() if ev.splitd else "status"
+    if action == "start":
+        if bot.profiler.start():
+            cli.msg(ev.target, ev.source + ": Profiling.")
+        else:
+            cli.msg(ev.target, ev.source + ": Already profiling.")
+    elif action == "stop":
+        if not bot.profiler.stop():
+            cli.msg(ev.target, ev.source + ": I wasn't profiling.")
+            return
+        try:
+            path = bot.profiler.save(bot.config.PROFILE_DIR)
+        except IOError as err:
+            path = "not saved ({})".format(err)
+        cli.msg(ev.target, "{}: Profile {}".format(ev.source, path))
+        for line in bot.profiler.report():
+            cli.msg(ev.target, line)
+    elif action == "status":
+        cli.msg(ev.target, "{}: {}".format(ev.source, "Profiling, " +
+                   bot.profiler.report()[0] if bot.profiler.running
+                   else "Not profiling."))
+    else:
+        cli.msg(ev.target, ev.source + ": profile [start|stop|status]")
+
+def latency(bot, cli, ev):
+    if cli.tracer is None:
+        cli.msg(ev.target, ev.source + ": Tracing is off (TRACE in the configuration).")
+        return
+    report = cli.tracer.report()
+    if not report:
+        cli.msg(ev.target, ev.source + ": Nothing traced yet.")
+        return
+    for name, count, p50, p90, p99, top in report:
+        cli.msg(ev.target, "{}: p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms max {:.1f}ms ({} lines)".format(
+                name, p50 * 1000, p90 * 1000, p99 * 1000, top * 1000, count))
+
+def _kib(size):
+    return "{:.1f} KiB".format(size / 1024.0)
+
+def memory(bot, cli, ev):
+    action = ev.splitd[0].lower() if ev.splitd else ""
+    if action == "start":
+        bot.memory.start()
+        cli.msg(ev.target, ev.source + ": Tracing allocations, \"memory diff\" shows what grew.")
+    elif action == "diff":
+        if not bot.memory.tracing:
+            cli.msg(ev.target, ev.source + ": Not tracing, \"memory start\" first.")
+            return
+        for where, size, count in bot.memory.diff():
+            cli.msg(ev.target, "{}: {:+.1f} KiB, {:+d} blocks".format(where, size / 1024.0, count))
+    elif action == "stop":
+        bot.memory.stop()
+        cli.msg(ev.target, ev.source + ": Not tracing allocations anymore.")
+    elif action == "":
+        extra = {}
+        if bot.history is not None:
+            extra["history"] = (sum(len(i) for i in bot.history.channels.values()), bot.history)
+        if bot.seen is not None:
+            extra["seen (unsaved)"] = (len(bot.seen.pending), bot.seen.pending)
+        report = state_report(cli, extra)
+        cli.msg(ev.target, "{}: {}".format(ev.source, ", ".join(
+                "{} {} ({})".format(count, name, _kib(size)) for name, count, size in report)))
+    else:
+        cli.msg(ev.target, ev.source + ": memory [start|diff|stop]")
+
+def announce(bot, cli, ev):
+    # Through the helper connections when there are some.
+    out = bot.pool or cli
+    for channel in list(cli.channels.values()):
+        out.privmsg(channel.name, " ".join(ev.splitd))
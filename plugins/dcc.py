@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+import os
+
+COMMANDS = {"chat": "chat", "get": "get"}
+ROLES = {"chat": ["owner", "admin"]}
+
+
+def chat(bot, cli, ev):
+    if bot.dcc is None:
+        cli.msg(ev.target, ev.source + ": DCC is off.")
+        return
+    try:
+        bot.dcc.chat(ev.source2)
+    except OSError as err:
+        cli.msg(ev.target, "{}: Cannot offer a DCC CHAT: {}".format(ev.source, err))
+
+def get(bot, cli, ev):
+    if bot.dcc is None or not bot.config.DCC_DIR:
+        cli.msg(ev.target, ev.source + ": I don't have any files.")
+        return
+    if not ev.splitd:
+        cli.msg(ev.target, ev.source + ": get <file>")
+        return
+    # Only what is right in DCC_DIR.
+    name = os.path.basename(ev.splitd[0])
+    path = os.path.join(bot.config.DCC_DIR, name)
+    if name.startswith(".") or not os.path.isfile(path):
+        cli.msg(ev.target, ev.source + ": I don't have that file.")
+        return
+    try:
+        bot.dcc.sendfile(ev.source2, path)
+    except OSError as err:
+        cli.msg(ev.target, "{}: Cannot send it: {}".format(ev.source, err))
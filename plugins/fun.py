@@ -0,0 +1,8 @@
+# -*- coding: utf-8 -*-
+import random
+
+COMMANDS = {"meow": "meow"}
+
+
+def meow(bot, cli, ev):
+    cli.msg(ev.target, random.choice(["“I’m trying to translate what my cat says and put it in a book, but how many homonyms are there for meow?” ― Jarod Kintz", "“I want to start a business making mint-flavored sunshine that comes in a can half full of meow-free rainbows. (Leprechauns sold separately.)” ― Jarod Kintz", "“Chairs have legs. Four of them, like my father. Meow.” ― Jarod Kintz", "“Be honest because you stole it, not because blue/green/yell a little yellow. Dandelions just don’t meow like regular lions.” ― Jarod Kintz", "“I have a bedroom rug that I feed. It’s not very flat, and it meows when I step on it.” ― Jarod Kintz", "“I bought you a box of karate chops, but it could be dangerous to open it with a knife. And cats are masters at getting into boxes, so here, try opening it with my portable meow maker. ” ― Jarod Kintz", "“Some dogs look like giant mustaches. I shaved mine off because it was barking too much. My love life has improved by leaps and meows.” ― Jarod Kintz"]))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import time
+
+COMMANDS = {"last": "last", "grep": "grep"}
+
+
+def _format(message):
+    when, nick, text = message
+    return "[{}] <{}> {}".format(time.strftime("%H:%M:%S", time.localtime(when)),
+                                 nick, text)
+
+def last(bot, cli, ev):
+    if bot.history is None:
+        cli.msg(ev.target, ev.source + ": I don't keep any history.")
+        return
+    try:
+        count = min(int(ev.splitd[0]), 5)
+    except (IndexError, ValueError):
+        count = 3
+    # Commands are handled before history records them, so our own isn't
+    # among these.
+    for message in bot.history.last(ev.target, count):
+        cli.msg(ev.target, _format(message))
+
+def grep(bot, cli, ev):
+    if bot.history is None:
+        cli.msg(ev.target, ev.source + ": I don't keep any history.")
+        return
+    if not ev.splitd:
+        cli.msg(ev.target, ev.source + ": grep <words>")
+        return
+    found = bot.history.search(ev.target, " ".join(ev.splitd), 3)
+    if not found:
+        cli.msg(ev.target, ev.source + ": Nothing found.")
+    for message in found:
+        cli.msg(ev.target, _format(message))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import time
+
+COMMANDS = {"seen": "seen"}
+
+
+def _ago(when):
+    seconds = int(time.time() - when)
+    parts = []
+    for name, length in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= length:
+            parts.append("{}{}".format(seconds // length, name))
+            seconds %= length
+    if not parts:
+        parts.append("{}s".format(seconds))
+    return " ".join(parts[:2])
+
+def seen(bot, cli, ev):
+    if bot.seen is None:
+        cli.msg(ev.target, ev.source + ": I don't remember anybody.")
+        return
+    if not ev.splitd:
+        cli.msg(ev.target, ev.source + ": seen <nick>")
+        return
+    row = bot.seen.lookup(ev.splitd[0])
+    if row is None:
+        cli.msg(ev.target, "{}: I have never seen {}.".format(ev.source,
+                                                             ev.splitd[0]))
+        return
+    nick, when, action, channel, text = row
+    if action == "said":
+        what = "on {}, saying: {}".format(channel, text)
+    elif action == "joined":
+        what = "joining {}".format(channel)
+    elif action == "parted":
+        what = "leaving {}{}".format(channel, text and " ({})".format(text) or "")
+    elif action == "quit":
+        what = "quitting{}".format(text and " ({})".format(text) or "")
+    elif action == "nickto":
+        what = "changing nick to {}".format(text)
+    else:
+        what = "changing nick from {}".format(text)
+    cli.msg(ev.target, "{}: {} was last seen {} ago, {}.".format(ev.source,
+                                                        nick, _ago(when), what))